@@ -1,6 +1,7 @@
 import cv2
 import numpy as np
-from typing import Dict, List
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List
 import numpy.typing as npt
 
 from context import DrawingContext, XYPoint, Size, WHITE, GREEN, RED
@@ -8,7 +9,27 @@ from snapshot import Corners, Image
 
 
 class MarkerProgram:
+    """A program drawn around a marker.
+
+    Subclasses draw into self.image in render(). update() only calls render()
+    when renderKey() changes, keeping the rasterised image for each recent key,
+    so programs whose content depends on more than the id should override
+    renderKey() to include that state.
+
+    Attributes:
+        renders (int): number of times render() was called by update()
+        cache_hits (int): number of update() calls served from the cache
+        version (int): incremented whenever the cached images are invalidated
+    """
+
+    CACHE_SIZE = 16
+
     def __init__(self, marker_width:int, size:Size, marker_position:XYPoint):
+        self.renders = 0
+        self.cache_hits = 0
+        self.version = 0
+        self._cache:OrderedDict[Any, Image] = OrderedDict()
+
         self.marker_width = marker_width
         self.size = size
         self.marker_position = marker_position
@@ -22,12 +43,69 @@ class MarkerProgram:
     def initialiseImage(self):
         self.image:Image = np.zeros((self.size.height, self.size.width, 3), np.uint8)
 
+    def renderKey(self, id:int) -> Hashable:
+        """Everything the rendered image depends on."""
+        return id
+
+    def invalidate(self) -> None:
+        """Drop cached images so the next update() renders again."""
+        self._cache.clear()
+        self.version += 1
+
+    def update(self, id:int) -> None:
+        """Make self.image the program's image for id, rendering only if needed."""
+        key = (self.version, self.renderKey(id))
+        image = self._cache.get(key)
+        if image is not None:
+            self._cache.move_to_end(key)
+            self.image = image
+            self.cache_hits += 1
+            return
+
+        self.initialiseImage()
+        self.render(id)
+        self.renders += 1
+        self._cache[key] = self.image
+        if len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    def transformTo(self, marker_corners:Corners) -> npt.NDArray[np.float64]:
+        # Four exact point pairs, so no need for a robust fit
+        homography:npt.NDArray[np.float64] = cv2.getPerspectiveTransform(
+            self.corners.reshape(4, 2).astype(np.float32),
+            np.asarray(marker_corners).reshape(4, 2).astype(np.float32),
+        )
+        return homography
+
     def finaliseImage(self, marker_corners:Corners, output_size:Size) -> Image:
 
-        homography, status = cv2.findHomography(self.corners, marker_corners, cv2.RANSAC)
+        homography = self.transformTo(marker_corners)
 
         return cv2.warpPerspective(self.image, homography, output_size)
 
+    def compositeOnto(self, image:Image, marker_corners:Corners) -> None:
+        """Draw the program image onto image in place, positioned by the marker.
+
+        Only the bounding box of the program on image is warped and blended,
+        so the cost scales with the program's on-screen size. Black pixels of
+        the program image are treated as transparent.
+        """
+        homography = self.transformTo(marker_corners)
+        outline = np.array([[[0, 0], [self.size.width, 0], [self.size.width, self.size.height], [0, self.size.height]]], np.float32)
+        outline = cv2.perspectiveTransform(outline, homography)[0]
+
+        rows, cols = image.shape[:2]
+        x1, y1 = np.maximum(np.floor(outline.min(axis=0)).astype(int), 0)
+        x2, y2 = np.minimum(np.ceil(outline.max(axis=0)).astype(int) + 1, [cols, rows])
+        if x1 >= x2 or y1 >= y2:
+            return
+
+        # Shift the transform so the box's top left is the origin
+        shift = np.array([[1, 0, -x1], [0, 1, -y1], [0, 0, 1]], np.float64)
+        warped = cv2.warpPerspective(self.image, shift.dot(homography), (int(x2 - x1), int(y2 - y1)))
+        mask = warped.any(axis=2)
+        image[y1:y2, x1:x2][mask] = warped[mask]
+
     def render(self, id:int) -> None:
         pass
 
@@ -0,0 +1,242 @@
+"""Offline end-to-end benchmark of the frame loop.
+
+Generates synthetic camera frames by warping AprilTags onto a background with
+a known homography, blur and noise, then drives Landscape.get_snapshot,
+Snapshot.warp, Snapshot.detect and headless_renderer.Renderer.render. Reports
+per-stage latency percentiles and detection recall for each marker count and
+camera resolution, and can save results as JSON to compare runs. Each stage
+is timed once and they don't overlap, so together they make up a frame.
+
+Usage:
+  python3 ./benchmark.py --output before.json
+  python3 ./benchmark.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import math
+import platform
+import time
+
+import cv2
+import numpy as np
+
+from typing import Dict, List
+
+import context
+import headless_renderer
+import snapshot
+import tinyland
+
+
+PROJECTOR_WIDTH = 1366
+PROJECTOR_HEIGHT = 768
+# Capture is Landscape.get_snapshot, which reads the frame and updates the
+# calibration. The Snapshot warps and detects lazily, in the stages after it.
+STAGES = ["capture", "warp", "detect", "render"]
+
+
+class SyntheticCamera:
+    """Stands in for cv2.VideoCapture, looping over pregenerated frames."""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.index = 0
+
+    def read(self):
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        return True, frame
+
+    def set(self, prop, value):
+        self.index = 0
+
+    def get(self, prop):
+        return 0
+
+
+def make_scene(marker_count, resolution, rng):
+    """Lay out markers on the table and place the table in the camera's view.
+
+    Returns:
+      (table, H, src_corners, truth): the table image in projector space, the
+      projector to camera homography, the table corners in the camera frame,
+      and a map from marker id to its center in projector space.
+    """
+    # Lay the markers out on a grid in projector space
+    cols = max(1, math.ceil(math.sqrt(marker_count * PROJECTOR_WIDTH / PROJECTOR_HEIGHT)))
+    rows = max(1, math.ceil(marker_count / cols))
+    cell = min(PROJECTOR_WIDTH / cols, PROJECTOR_HEIGHT / rows)
+    size = int(cell * 0.6)
+
+    table = np.full((PROJECTOR_HEIGHT, PROJECTOR_WIDTH), 255, np.uint8)
+    truth = {}
+    for i in range(marker_count):
+        marker_id = i + 1
+        r, c = divmod(i, cols)
+        cx = (c + 0.5) * cell + rng.uniform(-0.1, 0.1) * cell
+        cy = (r + 0.5) * cell + rng.uniform(-0.1, 0.1) * cell
+        tag = cv2.aruco.drawMarker(snapshot.ArucoDict, marker_id, size, borderBits=1)
+        x, y = int(cx - size / 2), int(cy - size / 2)
+        table[y:y + size, x:x + size] = tag
+        truth[marker_id] = (x + size / 2, y + size / 2)
+
+    # Place the table in the camera frame with a little perspective
+    width, height = resolution
+    margin = np.array([width, height]) * 0.08
+    jitter = rng.uniform(-0.03, 0.03, (4, 2)) * [width, height]
+    src_corners = np.array([
+        margin,
+        [width - margin[0], margin[1]],
+        [width - margin[0], height - margin[1]],
+        [margin[0], height - margin[1]],
+    ]) + jitter
+    dest_corners = np.array([[0, 0], [PROJECTOR_WIDTH, 0], [PROJECTOR_WIDTH, PROJECTOR_HEIGHT], [0, PROJECTOR_HEIGHT]])
+    H = cv2.getPerspectiveTransform(dest_corners.astype(np.float32), src_corners.astype(np.float32))
+    return table, H, src_corners, truth
+
+
+def camera_frame(table, H, resolution, rng, noise=6.0, blur=3):
+    """Warp the table onto a background as the camera would see it."""
+    width, height = resolution
+    background = rng.integers(60, 120, (height // 8 + 1, width // 8 + 1), dtype=np.uint8)
+    background = cv2.resize(background, (width, height), interpolation=cv2.INTER_LINEAR)
+    warped = cv2.warpPerspective(table, H, (width, height))
+    mask = cv2.warpPerspective(np.full_like(table, 255), H, (width, height)) > 0
+    frame = np.where(mask, warped, background)
+    if blur:
+        frame = cv2.GaussianBlur(frame, (blur, blur), 0)
+    frame = np.clip(frame + rng.normal(0, noise, frame.shape), 0, 255).astype(np.uint8)
+    return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+
+def recall(markers, truth, tolerance=5.0):
+    """Fraction of markers found within tolerance pixels of where they are."""
+    found = 0
+    for marker_id, (x, y) in truth.items():
+        for i in markers.indices(marker_id):
+            cx, cy = markers.corners[i].mean(axis=0)
+            if math.hypot(cx - x, cy - y) <= tolerance:
+                found += 1
+                break
+    return found / len(truth) if truth else 1.0
+
+
+def percentiles(samples):
+    ms = np.array(samples) * 1000
+    return {
+        "p50": float(np.percentile(ms, 50)),
+        "p90": float(np.percentile(ms, 90)),
+        "p99": float(np.percentile(ms, 99)),
+        "mean": float(ms.mean()),
+    }
+
+
+def run_case(marker_count, resolution, frames, seed):
+    rng = np.random.default_rng(seed)
+    table, H, src_corners, truth = make_scene(marker_count, resolution, rng)
+    # A few frames of the same scene with different noise
+    frames_in = [camera_frame(table, H, resolution, rng) for _ in range(4)]
+
+    l = tinyland.Landscape()
+    l.projector = {
+        "PROJECTOR_WIDTH": PROJECTOR_WIDTH,
+        "PROJECTOR_HEIGHT": PROJECTOR_HEIGHT,
+        "SRC_CORNERS": src_corners.tolist(),
+        "DEST_CORNERS": [[0, 0], [PROJECTOR_WIDTH, 0], [PROJECTOR_WIDTH, PROJECTOR_HEIGHT], [0, PROJECTOR_HEIGHT]],
+        "USE_CAMERA": True,
+        "FLIP_PROJECTION": False,
+        "IDENTIFY_ON_VIDEO": False,
+    }
+    l.camera = SyntheticCamera(frames_in)
+    r = headless_renderer.Renderer(PROJECTOR_WIDTH, PROJECTOR_HEIGHT)
+
+    timings:Dict[str, List[float]] = {stage: [] for stage in STAGES}
+    recalls = []
+    for _ in range(frames):
+        t0 = time.perf_counter()
+        snap = l.get_snapshot()
+        t1 = time.perf_counter()
+        image = snap.warp()
+        t2 = time.perf_counter()
+        markers = snap.detect()
+        t3 = time.perf_counter()
+        ctx = context.DrawingContext(PROJECTOR_WIDTH, PROJECTOR_HEIGHT)
+        for same_id in markers.values():
+            for marker in same_id:
+                ctx.rect(marker.center.x, marker.center.y, 5, 5)
+                ctx.text(marker.center.x, marker.center.y + 10, str(marker.id))
+        r.render(ctx, image)
+        t4 = time.perf_counter()
+
+        timings["capture"].append(t1 - t0)
+        timings["warp"].append(t2 - t1)
+        timings["detect"].append(t3 - t2)
+        timings["render"].append(t4 - t3)
+        recalls.append(recall(markers, truth))
+
+    return {
+        "markers": marker_count,
+        "resolution": list(resolution),
+        "frames": frames,
+        "recall": float(np.mean(recalls)),
+        "stages": {stage: percentiles(samples) for stage, samples in timings.items()},
+    }
+
+
+def case_key(case):
+    return "%dx%d/%d" % (case["resolution"][0], case["resolution"][1], case["markers"])
+
+
+def print_results(results, baseline=None):
+    base = {case_key(c): c for c in baseline["cases"]} if baseline else {}
+    header = "%-16s %7s" % ("case", "recall") + "".join(" %14s" % s for s in STAGES)
+    print(header)
+    for case in results["cases"]:
+        line = "%-16s %6.0f%%" % (case_key(case), case["recall"] * 100)
+        old = base.get(case_key(case))
+        for stage in STAGES:
+            p50 = case["stages"][stage]["p50"]
+            # Runs from before the stages were split up have no capture stage
+            if old and stage in old["stages"]:
+                change = (p50 / old["stages"][stage]["p50"] - 1) * 100 if old["stages"][stage]["p50"] else 0.0
+                line += " %7.2fms%+4.0f%%" % (p50, change)
+            else:
+                line += " %12.2fms" % p50
+        print(line)
+    print("(median latency per stage%s)" % (", change against baseline" if baseline else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--markers", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--resolutions", nargs="+", default=["640x480", "1280x720", "1920x1080"])
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier run to compare against")
+    args = parser.parse_args()
+
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "opencv": cv2.__version__,
+        "cases": [],
+    }
+    for res in args.resolutions:
+        width, height = (int(v) for v in res.split("x"))
+        for count in args.markers:
+            results["cases"].append(run_case(count, (width, height), args.frames, args.seed))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Microbenchmark of Snapshot.markers representations.
+
+Compares the old dict<int, list<ArucoMarker>> against MarkerSet, both through
+its per-marker views and its bulk arrays, at a few marker counts.
+
+A MarkerSet builds its views and center points on first access, so iterating a
+new one, as apps do once per frame, costs more than iterating a dict that was
+built with them. "total" is building plus iterating once, the per-frame cost.
+
+Usage: python3 ./benchmark_markerset.py
+"""
+import timeit
+
+import numpy as np
+
+from typing import Any, Callable, Dict, List
+
+from snapshot import ArucoMarker, MarkerSet, marker_centers, marker_rotations
+
+
+MARKER_COUNTS = [1, 50, 500]
+REPEATS = 200
+
+
+def random_markers(count, rng):
+    ids = rng.integers(0, 50, count).astype(np.int32)
+    centers = rng.uniform(0, 1000, (count, 1, 2))
+    offsets = np.array([[-10, -10], [10, -10], [10, 10], [-10, 10]])
+    corners = (centers + offsets).astype(np.float32)
+    return ids, corners, corners.copy()
+
+
+def build_dict(ids, corners, raw_corners):
+    centers = marker_centers(corners)
+    rotations = marker_rotations(corners)
+    markers:Dict[int, List[ArucoMarker]] = {}
+    for i, marker_id in enumerate(ids.tolist()):
+        markers.setdefault(marker_id, []).append(
+            ArucoMarker(marker_id, corners[i:i+1], raw_corners[i:i+1], centers[i], rotations[i])
+        )
+    return markers
+
+
+def build_set(ids, corners, raw_corners):
+    return MarkerSet(ids, corners, raw_corners)
+
+
+def iterate(markers):
+    # What pong.app and helloWorld.app do every frame
+    total = 0.0
+    for group in markers.values():
+        for marker in group:
+            total += marker.center.x
+    return total
+
+
+def iterate_bulk(markers):
+    return float(markers.centers[:, 0].sum())
+
+
+def per_frame_us(fn:Callable[[], Any]) -> float:
+    return min(timeit.repeat(fn, number=REPEATS, repeat=5)) / REPEATS * 1e6
+
+
+def first_pass_us(fn:Callable[[Any], Any], make:Callable[[], Any]) -> float:
+    """Time fn on a fresh make() each run, leaving out the time to make it."""
+    made:List[Any] = [None]
+
+    def setup() -> None:
+        made[0] = make()
+    timer = timeit.Timer(lambda: fn(made[0]), setup=setup)
+    return min(timer.repeat(number=1, repeat=REPEATS)) * 1e6
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print("%8s  %12s  %12s  %12s  %12s  %12s  %12s  %12s" % (
+        "markers", "dict build", "set build", "dict iter", "set iter", "dict total", "set total", "set bulk"))
+    for count in MARKER_COUNTS:
+        arrays = random_markers(count, rng)
+        as_dict = build_dict(*arrays)
+        as_set = build_set(*arrays)
+        print("%8d  %10.1fus  %10.1fus  %10.1fus  %10.1fus  %10.1fus  %10.1fus  %10.1fus" % (
+            count,
+            per_frame_us(lambda: build_dict(*arrays)),
+            per_frame_us(lambda: build_set(*arrays)),
+            per_frame_us(lambda: iterate(as_dict)),
+            # A fresh set each run, so views aren't reused between frames
+            first_pass_us(iterate, lambda: build_set(*arrays)),
+            per_frame_us(lambda: iterate(build_dict(*arrays))),
+            per_frame_us(lambda: iterate(build_set(*arrays))),
+            per_frame_us(lambda: iterate_bulk(as_set)),
+        ))
+
+
+if __name__ == "__main__":
+    main()
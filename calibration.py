@@ -0,0 +1,96 @@
+import cv2
+import numpy as np
+import numpy.typing as npt
+
+from typing import Callable, Optional, Tuple
+
+from snapshot import Corners, Image
+
+
+class Calibration:
+    """Camera to projector mapping, cached between calibrations.
+
+    Holds the homography from camera space to projector space, its inverse and
+    the cv2.remap lookup maps that warp a camera frame into projector space.
+    The projection flip is folded into the maps, so warping is a single pass.
+    Everything is rebuilt only when the corners, projector size or flip change.
+
+    Attributes:
+        homography (numpy.ndarray): 3x3 camera to projector homography
+        inverse (numpy.ndarray): 3x3 projector to camera homography
+        map1, map2 (numpy.ndarray): fixed point lookup maps for cv2.remap
+    """
+
+    def __init__(self):
+        self.homography:npt.NDArray[np.float64] = np.eye(3)
+        self.inverse:npt.NDArray[np.float64] = np.eye(3)
+        # Replaced as a pair, so a warp on another thread never mixes old and new
+        self._maps:Tuple[Optional[npt.NDArray[np.int16]], Optional[npt.NDArray[np.uint16]]] = (None, None)
+        self._key:Optional[Tuple[bytes, bytes, int, int, bool]] = None
+
+    def update(self, src_corners:Corners, dest_corners:Corners, width:int, height:int, flip:bool) -> bool:
+        """Rebuild the cached state if any of its inputs changed.
+
+        Returns:
+          True if the state was rebuilt.
+        """
+        src = np.asarray(src_corners, dtype=np.float64).reshape(-1, 2)
+        dest = np.asarray(dest_corners, dtype=np.float64).reshape(-1, 2)
+        key = (src.tobytes(), dest.tobytes(), int(width), int(height), bool(flip))
+        if key == self._key:
+            return False
+
+        homography, status = cv2.findHomography(src, dest)
+        if homography is None:
+            print("Could not compute a homography from the corners, keeping the previous calibration.")
+            return False
+
+        self.homography = homography
+        self.inverse = np.linalg.inv(homography)
+        self._maps = self._build_maps(self.inverse, width, height, flip)
+        self._key = key
+        return True
+
+    @staticmethod
+    def _build_maps(inverse, width, height, flip):
+        xs, ys = np.meshgrid(np.arange(width, dtype=np.float64), np.arange(height, dtype=np.float64))
+        if flip:
+            # Same as cv2.flip(image, -1) on the warped image
+            xs = width - 1 - xs
+            ys = height - 1 - ys
+        src = inverse[:, 0, None, None] * xs + inverse[:, 1, None, None] * ys + inverse[:, 2, None, None]
+        map_x = (src[0] / src[2]).astype(np.float32)
+        map_y = (src[1] / src[2]).astype(np.float32)
+        return cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+    @property
+    def map1(self) -> Optional[npt.NDArray[np.int16]]:
+        return self._maps[0]
+
+    @property
+    def map2(self) -> Optional[npt.NDArray[np.uint16]]:
+        return self._maps[1]
+
+    def warp(self, image:Image, dst:Optional[Image]=None) -> Image:
+        """Warp a camera frame into (optionally flipped) projector space.
+
+        Args:
+          image (numpy.ndarray): camera frame
+          dst (numpy.ndarray): optional preallocated output image
+        """
+        map1, map2 = self._maps
+        warped:Image = cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=dst)
+        return warped
+
+    def warper(self) -> Callable[[Image], Image]:
+        """warp() with the current maps, unaffected by later calibrations.
+
+        For warping a frame lazily, possibly on another thread, with the
+        calibration it was captured under.
+        """
+        map1, map2 = self._maps
+
+        def warp(image:Image) -> Image:
+            warped:Image = cv2.remap(image, map1, map2, cv2.INTER_LINEAR)
+            return warped
+        return warp
@@ -0,0 +1,261 @@
+import json
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from typing import List, Optional
+
+from snapshot import Image
+
+
+class ThreadedCapture:
+    """Read frames from a cv2.VideoCapture on a background thread.
+
+    The producer thread keeps reading into a small ring of preallocated frame
+    buffers so that read() can hand back the newest frame straight away instead
+    of blocking on the camera. Frames that were captured but never handed out
+    are counted as dropped.
+
+    Args:
+        camera (cv2.VideoCapture): an opened capture device or video file
+        buffers (int): number of frame buffers in the ring, at least 3 so that
+          one can be written, one published and one held by the consumer
+        rewind (bool): seek back to the start when the capture runs out of
+          frames, as when looping a video file for offline testing. A capture
+          that still gives no frames after MAX_FAILED_REWINDS rewinds in a
+          row is treated as ended.
+        pace (bool): sleep between reads at the capture's reported FPS, useful
+          for video files which would otherwise decode as fast as possible
+    Attributes:
+        dropped_frames (int): frames captured but replaced before being read
+        frame_age (float): age in seconds of the last frame returned by read()
+    """
+
+    MAX_FAILED_REWINDS = 10
+
+    def __init__(self, camera:cv2.VideoCapture, buffers:int=3, rewind:bool=False, pace:bool=False):
+        self.camera = camera
+        self.rewind = rewind
+        self.dropped_frames = 0
+        self.frame_age = 0.0
+
+        self._buffers:List[Optional[Image]] = [None] * max(3, buffers)
+        self._timestamps = [0.0] * len(self._buffers)
+        self._latest = -1
+        self._held = -1
+        self._consumed = True
+        self._interval = 0.0
+        if pace:
+            fps = camera.get(cv2.CAP_PROP_FPS)
+            if fps > 0:
+                self._interval = 1.0 / fps
+
+        self._cond = threading.Condition()
+        self._running = True
+        self._error:Optional[Exception] = None
+        self._thread = threading.Thread(target=self._produce, name="ThreadedCapture", daemon=True)
+        self._thread.start()
+
+    def _next_slot(self):
+        for i in range(1, len(self._buffers) + 1):
+            slot = (self._latest + i) % len(self._buffers)
+            if slot != self._latest and slot != self._held:
+                return slot
+        return 0
+
+    def _produce(self):
+        try:
+            next_read = time.monotonic()
+            failed_rewinds = 0
+            while self._running:
+                with self._cond:
+                    slot = self._next_slot()
+                ok, frame = self.camera.read(self._buffers[slot])
+                if not ok or frame is None:
+                    if self.rewind and failed_rewinds < self.MAX_FAILED_REWINDS:
+                        # Back off, so an unreadable or empty video doesn't spin
+                        time.sleep(0.01 * failed_rewinds)
+                        failed_rewinds += 1
+                        self.camera.set(cv2.CAP_PROP_POS_MSEC, 0)
+                        continue
+                    break
+                failed_rewinds = 0
+                captured = time.monotonic()
+
+                with self._cond:
+                    self._buffers[slot] = frame
+                    self._timestamps[slot] = captured
+                    if not self._consumed:
+                        self.dropped_frames += 1
+                    self._latest = slot
+                    self._consumed = False
+                    self._cond.notify_all()
+
+                if self._interval:
+                    next_read = max(next_read + self._interval, captured)
+                    time.sleep(max(0.0, next_read - time.monotonic()))
+        except Exception as e:
+            # Handed to the consumer by read()
+            self._error = e
+        finally:
+            with self._cond:
+                self._running = False
+                self._cond.notify_all()
+
+    def read(self):
+        """Return the newest captured frame, waiting only for the very first.
+
+        The returned array stays valid until the next call to read(). Once
+        the capture has ended and its last frame has been read, returns
+        (False, None). Raises the exception that stopped the producer thread,
+        if any.
+
+        Returns:
+          (ok, frame) in the same form as cv2.VideoCapture.read().
+        """
+        with self._cond:
+            while self._latest == -1 and self._running:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+            if self._latest == -1 or (self._consumed and not self._running):
+                return False, None
+            self._held = self._latest
+            self._consumed = True
+            self.frame_age = time.monotonic() - self._timestamps[self._held]
+            return True, self._buffers[self._held]
+
+    def get(self, prop):
+        return self.camera.get(prop)
+
+    def set(self, prop, value):
+        return self.camera.set(prop, value)
+
+    def release(self):
+        with self._cond:
+            self._running = False
+        self._thread.join(timeout=1)
+        self.camera.release()
+
+
+class FrameCache:
+    """Video file input decoded once into a memory-mapped raw frame file.
+
+    The first time a clip is used its frames are decoded one at a time and
+    appended to a raw file next to it, so decoding needs only one frame of
+    memory. After that read() serves read-only views straight from the memory
+    map, and looping back to the start is just resetting an index. The cache
+    is rebuilt if the clip's size or modification time changes.
+
+    Args:
+        video_path (str): clip to decode
+        cache_path (str): raw frame file, by default video_path + ".frames"
+        max_frames (int): only decode this many frames of long clips, 0 for all
+        pace (bool): sleep between reads at the clip's FPS
+    """
+
+    MAGIC = b"TLFRAMES"
+    HEADER_SIZE = 4096
+
+    def __init__(self, video_path:str, cache_path:Optional[str]=None, max_frames:int=0, pace:bool=False):
+        self.video_path = video_path
+        self.cache_path = cache_path or video_path + ".frames"
+        self.max_frames = max_frames
+
+        source = os.stat(video_path)
+        self._source = {"size": source.st_size, "mtime": source.st_mtime_ns, "max_frames": max_frames}
+        meta = self._read_header()
+        if meta is None or meta["source"] != self._source:
+            meta = self._decode()
+
+        self.fps = meta["fps"]
+        self.frames = np.memmap(
+            self.cache_path, np.uint8, mode="r", offset=self.HEADER_SIZE,
+            shape=(meta["count"],) + tuple(meta["shape"]),
+        ) if meta["count"] else np.zeros((0,) + tuple(meta["shape"]), np.uint8)
+        self.index = 0
+        self._interval = 1.0 / self.fps if pace and self.fps > 0 else 0.0
+        self._next_read = 0.0
+
+    def _read_header(self):
+        try:
+            with open(self.cache_path, "rb") as f:
+                header = f.read(self.HEADER_SIZE)
+        except OSError:
+            return None
+        if not header.startswith(self.MAGIC):
+            return None
+        return json.loads(header[len(self.MAGIC):].rstrip(b"\0"))
+
+    def _decode(self):
+        print("Decoding %s into %s... " % (self.video_path, self.cache_path), end="", flush=True)
+        camera = cv2.VideoCapture(self.video_path)
+        fps = camera.get(cv2.CAP_PROP_FPS)
+        count = 0
+        shape = [0, 0, 3]
+        with open(self.cache_path, "wb") as f:
+            f.write(b"\0" * self.HEADER_SIZE)
+            while not self.max_frames or count < self.max_frames:
+                ok, frame = camera.read()
+                if not ok or frame is None:
+                    break
+                shape = list(frame.shape)
+                f.write(np.ascontiguousarray(frame).tobytes())
+                count += 1
+            meta = {"source": self._source, "fps": fps, "count": count, "shape": shape}
+            # Write the header last so an interrupted decode isn't mistaken for a cache
+            f.seek(0)
+            f.write(self.MAGIC + json.dumps(meta).encode())
+        camera.release()
+        print("%s frames" % count)
+        return meta
+
+    def read(self, image=None):
+        """Return (ok, frame) like cv2.VideoCapture.read(), without copying.
+
+        Returns (False, None) at the end of the clip. If a writable image is
+        given, the frame is copied into it instead. A read-only image, such
+        as a frame returned by an earlier read() that ThreadedCapture passes
+        back, is left alone.
+        """
+        if self.index >= len(self.frames):
+            return False, None
+        if self._interval:
+            now = time.monotonic()
+            if self._next_read > now:
+                time.sleep(self._next_read - now)
+            self._next_read = max(self._next_read + self._interval, now)
+        frame = self.frames[self.index]
+        self.index += 1
+        if image is not None and image.flags.writeable and image.shape == frame.shape:
+            np.copyto(image, frame)
+            return True, image
+        return True, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return len(self.frames)
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.index
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.frames.shape[2]
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.frames.shape[1]
+        return 0
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.index = int(value)
+        elif prop == cv2.CAP_PROP_POS_MSEC:
+            self.index = int(value / 1000 * self.fps) if self.fps else 0
+        else:
+            return False
+        return True
+
+    def release(self):
+        self.frames = np.zeros((0,) + self.frames.shape[1:], np.uint8)
@@ -1,12 +1,17 @@
 from collections import namedtuple
 
-from typing import List
+import numpy as np
+
+from typing import Any, Dict, List, Sequence, Tuple
 
 
 # Convenience class that allows indexing as well as x and y attribute access
 XYPoint = namedtuple("XYPoint", ["x", "y"])
 Size = namedtuple("Size", ["width", "height"])
 Colour = namedtuple("Colour", ["r", "g", "b"])
+# Shapes of a DrawingContext: rects and circles as RECT_DTYPE and CIRCLE_DTYPE
+# rows, and others as (draw order, Shape) pairs
+Changes = namedtuple("Changes", ["rects", "circles", "others"])
 
 
 # BGR color values
@@ -20,6 +25,41 @@ MAGENTA = Colour(255, 0, 255)
 YELLOW = Colour(0, 255, 255)
 
 
+def merge_rects(rects:Sequence[Sequence[int]]) -> List[List[int]]:
+    """Merge overlapping [x1, y1, x2, y2] rectangles until none overlap.
+
+    Each pass sweeps the rectangles from left to right, joins every group of
+    overlapping ones into its bounding box, and repeats if the boxes overlap.
+    """
+    merged = [list(r) for r in rects]
+    while True:
+        merged.sort()
+        group = list(range(len(merged)))
+
+        def find(i:int) -> int:
+            while group[i] != i:
+                group[i] = group[group[i]]
+                i = group[i]
+            return i
+
+        joined = False
+        active:List[int] = []  # Rectangles reaching past the sweep line
+        for i, (x1, y1, x2, y2) in enumerate(merged):
+            active = [j for j in active if merged[j][2] > x1]
+            for j in active:
+                if merged[j][1] < y2 and y1 < merged[j][3] and find(i) != find(j):
+                    group[find(j)] = find(i)
+                    joined = True
+            active.append(i)
+        if not joined:
+            return merged
+        boxes:Dict[int, List[int]] = {}
+        for i, r in enumerate(merged):
+            box = boxes.setdefault(find(i), list(r))
+            box[:] = [min(box[0], r[0]), min(box[1], r[1]), max(box[2], r[2]), max(box[3], r[3])]
+        merged = list(boxes.values())
+
+
 class Shape:
     """Base class for shapes to draw on the landscape."""
 
@@ -27,12 +67,19 @@ class Shape:
         self.center = XYPoint(x, y)
         self.color = color
 
+    def key(self) -> Tuple[Any, ...]:
+        """Everything that affects how the shape is drawn, for comparing frames."""
+        return (type(self).__name__, tuple(self.center), tuple(self.color))
+
 
 class Circle(Shape):
     def __init__(self, x:int, y:int, radius:int, color:Colour):
         super().__init__(x, y, color)
         self.radius = radius
 
+    def key(self):
+        return super().key() + (self.radius,)
+
 
 class Rectangle(Shape):
     def __init__(self, x:int, y:int, width:int, height:int, rotation:float, color:Colour):
@@ -41,6 +88,9 @@ class Rectangle(Shape):
         self.height = height
         self.rotation = rotation
 
+    def key(self):
+        return super().key() + (self.width, self.height, self.rotation)
+
 
 class Text(Shape):
     def __init__(self, x:int, y:int, content:str, color:Colour, size:Size):
@@ -48,6 +98,9 @@ class Text(Shape):
         self.content = str(content)
         self.size = size
 
+    def key(self):
+        return super().key() + (self.content, self.size)
+
 
 class Image(Shape):
     def __init__(self, filepath, x, y, width, height):
@@ -56,32 +109,222 @@ class Image(Shape):
         self.height = height
         self.filepath = filepath
 
+    def key(self):
+        return super().key() + (self.filepath, self.width, self.height)
+
+
+class ShapeBuffer:
+    """Growable struct-of-arrays storage for many shapes of one kind.
+
+    Args:
+        dtype (numpy.dtype): structured dtype with one field per attribute
+    """
+
+    def __init__(self, dtype):
+        self._data = np.zeros(16, dtype)
+        self.count = 0
+
+    @property
+    def data(self):
+        """The stored shapes as a structured array."""
+        return self._data[:self.count]
+
+    def _reserve(self, n):
+        if self.count + n > len(self._data):
+            grown = np.zeros(max(2 * len(self._data), self.count + n), self._data.dtype)
+            grown[:self.count] = self._data[:self.count]
+            self._data = grown
+
+    def append(self, values:Tuple[Any, ...]) -> None:
+        self._reserve(1)
+        self._data[self.count] = values
+        self.count += 1
+
+    def extend(self, n:int, **columns:Any) -> None:
+        self._reserve(n)
+        rows = self._data[self.count:self.count + n]
+        for name, column in columns.items():
+            rows[name] = column
+        self.count += n
+
+    def clear(self):
+        self.count = 0
+
+    def __getstate__(self):
+        # Only pickle the stored shapes, not the spare capacity
+        return {"_data": self.data.copy(), "count": self.count}
+
+
+RECT_DTYPE = np.dtype([
+    ("order", "<i8"), ("x", "<f8"), ("y", "<f8"), ("width", "<f8"), ("height", "<f8"),
+    ("rotation", "<f8"), ("color", "u1", 3),
+])
+CIRCLE_DTYPE = np.dtype([("order", "<i8"), ("x", "<f8"), ("y", "<f8"), ("radius", "<f8"), ("color", "u1", 3)])
+
+
+def _diff_rows(previous, current):
+    """Rows of two structured arrays that differ, compared position by
+    position, as (rows only in previous, rows only in current)."""
+    n = min(len(previous), len(current))
+    differs = previous[:n] != current[:n]
+    return (
+        np.concatenate([previous[:n][differs], previous[n:]]),
+        np.concatenate([current[:n][differs], current[n:]]),
+    )
+
+
+def _build_shapes(rects:Any, circles:Any, others:List[Tuple[int, Shape]]) -> Tuple[Shape, ...]:
+    shapes:List[Tuple[int, Shape]] = list(others)
+    for r, color in zip(rects[["order", "x", "y", "width", "height", "rotation"]].tolist(), rects["color"].tolist()):
+        shapes.append((r[0], Rectangle(r[1], r[2], r[3], r[4], r[5], Colour(*color))))
+    for c, color in zip(circles[["order", "x", "y", "radius"]].tolist(), circles["color"].tolist()):
+        shapes.append((c[0], Circle(c[1], c[2], c[3], Colour(*color))))
+    shapes.sort(key=lambda item: item[0])
+    return tuple(shape for _, shape in shapes)
+
 
 class DrawingContext:
     """Context with all information to project a drawing onto the landscape.
 
+    Rectangles and circles are stored in ShapeBuffers so that thousands of
+    them can be added with rects() and circles() and drawn in bulk. Text and
+    images are kept as Shape objects. Everything is drawn in the order it was
+    added.
+
     Args:
         width (int): width of the drawing
         height (int): height of the drawing
     Attributes:
         width (int): width of the drawing
         height (int): height of the drawing
-        shapes (list<Shape>): shapes to draw
+        shapes (tuple<Shape>): shapes to draw, built from the buffers on
+          access. It's a tuple so that ctx.shapes.append() fails rather than
+          changing a copy; use add(), or assign a new sequence.
+        rect_buffer (ShapeBuffer): rectangles, with RECT_DTYPE fields
+        circle_buffer (ShapeBuffer): circles, with CIRCLE_DTYPE fields
+        others (list<(int, Shape)>): other shapes with their draw order
+        previous_shapes (tuple<Shape>): shapes drawn in the previous frame, when
+          the context is reused between frames with clear(), built on access
+        dt (float): seconds since the app was last run, 0 on the first frame
+        snapshot_age (float): seconds since the Snapshot's frame was captured
     """
 
     def __init__(self, width:int, height:int):
         self.width = width
         self.height = height
-        self.shapes:List[Shape] = []
+        self.rect_buffer = ShapeBuffer(RECT_DTYPE)
+        self.circle_buffer = ShapeBuffer(CIRCLE_DTYPE)
+        self.others:List[Tuple[int, Shape]] = []
+        self.count = 0
+        self._previous = Changes(np.zeros(0, RECT_DTYPE), np.zeros(0, CIRCLE_DTYPE), [])
+        self.dt = 0.0
+        self.snapshot_age = 0.0
+
+    @property
+    def shapes(self) -> Tuple[Shape, ...]:
+        return _build_shapes(self.rect_buffer.data, self.circle_buffer.data, self.others)
+
+    @shapes.setter
+    def shapes(self, shapes:Sequence[Shape]) -> None:
+        self._reset()
+        for shape in shapes:
+            self.add(shape)
+
+    def _reset(self):
+        self.rect_buffer.clear()
+        self.circle_buffer.clear()
+        self.others = []
+        self.count = 0
+
+    def add(self, shape:Shape) -> None:
+        """Add a Shape object to be drawn after everything added so far."""
+        if isinstance(shape, Rectangle):
+            self.rect(shape.center.x, shape.center.y, shape.width, shape.height, shape.rotation, shape.color)
+        elif isinstance(shape, Circle):
+            self.circle(shape.center.x, shape.center.y, shape.radius, shape.color)
+        else:
+            self.others.append((self.count, shape))
+            self.count += 1
+
+    def merge(self, other:"DrawingContext") -> None:
+        """Add every shape of another context, in its order, after the shapes
+        already here."""
+        for buffer, rows in ((self.rect_buffer, other.rect_buffer.data), (self.circle_buffer, other.circle_buffer.data)):
+            columns = {name: rows[name] for name in rows.dtype.names}
+            columns["order"] = rows["order"] + self.count
+            buffer.extend(len(rows), **columns)
+        self.others.extend((order + self.count, shape) for order, shape in other.others)
+        self.count += other.count
+
+    def kinds(self):
+        """Array giving, for each position in draw order, 0 for a rectangle,
+        1 for a circle and 2 for any other shape."""
+        kinds = np.full(self.count, 2, np.int8)
+        kinds[self.rect_buffer.data["order"]] = 0
+        kinds[self.circle_buffer.data["order"]] = 1
+        return kinds
+
+    @property
+    def previous_shapes(self) -> Tuple[Shape, ...]:
+        return _build_shapes(*self._previous)
+
+    def clear(self):
+        """Start a new frame, keeping this frame's shapes to diff against."""
+        self._previous = Changes(self.rect_buffer.data.copy(), self.circle_buffer.data.copy(), self.others)
+        self._reset()
+
+    def changes(self) -> Tuple[Changes, Changes]:
+        """Shapes removed since the previous frame, and shapes added in this one.
+
+        Each buffer is compared with the previous frame's row by row, draw
+        order included, so a shape that moved, changed or swapped places with
+        another shows up as both removed and added.
+        """
+        removed_rects, added_rects = _diff_rows(self._previous.rects, self.rect_buffer.data)
+        removed_circles, added_circles = _diff_rows(self._previous.circles, self.circle_buffer.data)
+        previous, current = self._previous.others, self.others
+        n = min(len(previous), len(current))
+        differs = [
+            i for i in range(n)
+            if previous[i][0] != current[i][0] or previous[i][1].key() != current[i][1].key()
+        ]
+        return (
+            Changes(removed_rects, removed_circles, [previous[i] for i in differs] + previous[n:]),
+            Changes(added_rects, added_circles, [current[i] for i in differs] + current[n:]),
+        )
 
     def rect(self, x, y, width, height, rotation=0, color=WHITE):
-        self.shapes.append(Rectangle(x, y, width, height, rotation, color))
+        self.rect_buffer.append((self.count, x, y, width, height, rotation, tuple(color)))
+        self.count += 1
+
+    def rects(self, xs, ys, widths, heights, rotations=0, colors=WHITE):
+        """Add many rectangles at once. Arguments are arrays or single values."""
+        n = len(xs)
+        self.rect_buffer.extend(
+            n,
+            order=np.arange(self.count, self.count + n),
+            x=xs, y=ys, width=widths, height=heights, rotation=rotations,
+            color=np.broadcast_to(np.asarray(colors), (n, 3)),
+        )
+        self.count += n
 
     def circle(self, x, y, radius, color=WHITE):
-        self.shapes.append(Circle(x, y, radius, color))
+        self.circle_buffer.append((self.count, x, y, radius, tuple(color)))
+        self.count += 1
+
+    def circles(self, xs, ys, radii, colors=WHITE):
+        """Add many circles at once. Arguments are arrays or single values."""
+        n = len(xs)
+        self.circle_buffer.extend(
+            n,
+            order=np.arange(self.count, self.count + n),
+            x=xs, y=ys, radius=radii,
+            color=np.broadcast_to(np.asarray(colors), (n, 3)),
+        )
+        self.count += n
 
     def text(self, x, y, content, color=WHITE, size=2):
-        self.shapes.append(Text(x, y, content, color, size))
+        self.add(Text(x, y, content, color, size))
 
     def image(self, filepath, x, y, width, height):
-        self.shapes.append(Image(filepath, x, y, width, height))
+        self.add(Image(filepath, x, y, width, height))
@@ -1,16 +1,154 @@
+import os
+from collections import OrderedDict
+
 import cv2
 import numpy as np
 
 import context
 import renderer
 
+from context import merge_rects
+
+
+class AssetCache:
+    """LRU cache of decoded, resized images for context.Image shapes.
+
+    Images are stored as uint8 with their colour premultiplied by alpha,
+    alongside 255 - alpha (None for opaque images), ready for composite().
+    An entry is reloaded if its file's mtime changes, and the least recently
+    used entries are evicted to stay under max_bytes.
+
+    Args:
+        max_bytes (int): memory budget for cached images
+    Attributes:
+        hits, misses, evictions (int): lookup counters
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, filepath, width, height):
+        """Return (premultiplied colour, inverse alpha) for an image file.
+
+        Returns None if the file can't be read.
+        """
+        key = (filepath, width, height)
+        try:
+            mtime = os.stat(filepath).st_mtime_ns
+        except OSError:
+            mtime = None
+
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == mtime:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        if entry is not None:
+            self._remove(key)
+        asset = self._load(filepath, width, height)
+        if asset is None:
+            return None
+        self._entries[key] = (mtime, asset)
+        self.bytes += sum(a.nbytes for a in asset if a is not None)
+        while self.bytes > self.max_bytes and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+        return asset
+
+    def _remove(self, key):
+        _, asset = self._entries.pop(key)
+        self.bytes -= sum(a.nbytes for a in asset if a is not None)
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    @staticmethod
+    def _load(filepath, width, height):
+        file_image = cv2.imread(filepath, cv2.IMREAD_UNCHANGED)
+        if file_image is None:
+            return None
+        file_image = cv2.resize(file_image, (width, height))
+        if file_image.ndim == 2:
+            file_image = cv2.cvtColor(file_image, cv2.COLOR_GRAY2BGR)
+        if file_image.shape[2] < 4 or file_image[:, :, 3].min() == 255:
+            return np.ascontiguousarray(file_image[:, :, :3]), None
+        alpha = file_image[:, :, 3:4]
+        premultiplied = cv2.multiply(file_image[:, :, :3], np.repeat(alpha, 3, axis=2), scale=1 / 255)
+        return premultiplied, 255 - alpha
+
+
+def composite(image, premultiplied, alpha_inv, x, y):
+    """Blend premultiplied uint8 pixels onto image in place with top left at (x, y).
+
+    The source is clipped to the image, so partially off-screen sources are
+    drawn in part.
+
+    Args:
+      image (numpy.ndarray): H x W x 3 uint8 destination
+      premultiplied (numpy.ndarray): h x w x 3 uint8 colour premultiplied by alpha
+      alpha_inv (numpy.ndarray): h x w x 1 uint8 of 255 - alpha, or None if opaque
+      x, y (int): position of the source's top left corner
+    """
+    h, w = premultiplied.shape[:2]
+    x1, y1 = max(x, 0), max(y, 0)
+    x2, y2 = min(x + w, image.shape[1]), min(y + h, image.shape[0])
+    if x1 >= x2 or y1 >= y2:
+        return
+    src = premultiplied[y1 - y:y2 - y, x1 - x:x2 - x]
+    roi = image[y1:y2, x1:x2]
+    if alpha_inv is None:
+        roi[:] = src
+        return
+    # Fixed point dst * alpha_inv / 255, rounded
+    blended = roi.astype(np.uint16) * alpha_inv[y1 - y:y2 - y, x1 - x:x2 - x]
+    blended += 128
+    blended += blended >> 8
+    blended >>= 8
+    roi[:] = cv2.add(src, blended.astype(np.uint8))
+
+
+def rect_corners(x, y, width, height, rotation):
+    """Integer corners of rotated rectangles, as an N x 4 x 2 array.
+
+    Args:
+      x, y, width, height, rotation (numpy.ndarray): one value per rectangle,
+        with rotation in degrees
+    """
+    hx = (np.asarray(width) / 2).astype(int)[:, None]
+    hy = (np.asarray(height) / 2).astype(int)[:, None]
+    dx = np.hstack([-hx, hx, hx, -hx])
+    dy = np.hstack([hy, hy, -hy, -hy])
+    rad = np.radians(rotation)[:, None]
+    cos, sin = np.cos(rad), np.sin(rad)
+    xs = cos * dx - sin * dy + np.asarray(x)[:, None]
+    ys = sin * dx + cos * dy + np.asarray(y)[:, None]
+    return np.stack([xs, ys], axis=2).astype(int)
+
 
 class Renderer(renderer.Renderer):
     WINDOW_TITLE = "Tinyland"
 
-    def __init__(self, width, height):
+    def __init__(self, width, height, cache_bytes=64 * 1024 * 1024):
         self.width = width
         self.height = height
+        self.assets = AssetCache(cache_bytes)
+
+        # Retained mode state and redraw counters
+        self.full_redraw_fraction = 0.5
+        self.full_redraw_shapes = 500
+        self.redrawn_fraction = 0.0
+        self.redrawn_pixels = 0
+        self.rendered_pixels = 0
+        self._frame = None
+        self._last_ctx = None
 
     def setup(self):
         """Create the OpenCV window to display images to."""
@@ -26,6 +164,7 @@ class Renderer(renderer.Renderer):
             cv2.setWindowProperty(Renderer.WINDOW_TITLE, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_NORMAL)
 
     def show_calibration_markers(self):
+        self._frame = None
         image = np.zeros((self.height, self.width, 3), np.uint8)
 
         # Display calibration markers until we find them
@@ -49,59 +188,221 @@ class Renderer(renderer.Renderer):
 
         Process all shapes in the context and render resulting image.
 
+        When no image is given and the same context is rendered again after
+        ctx.clear(), only the regions covered by shapes that changed since the
+        last frame are cleared and redrawn into a persistent frame. If more
+        than full_redraw_shapes shapes changed, or they cover more than
+        full_redraw_fraction of the frame, the whole frame is redrawn instead.
+
         Args:
           ctx (context.DrawingContext): A context with shapes to draw
+          image (numpy.ndarray): optional image to draw over
         """
-        if image is None:
-            image = np.zeros((self.height, self.width, 3), np.uint8)
-
-        for shape in ctx.shapes:
-            if isinstance(shape, context.Rectangle):
-                x = int(shape.width / 2)
-                y = int(shape.height / 2)
-                rad = np.radians(shape.rotation)
-                rotation = np.array([[np.cos(rad), -np.sin(rad)], [np.sin(rad), np.cos(rad)]])
-                translation = np.array([[shape.center.x], [shape.center.y]])
-                corners = np.array([[-x, x, x, -x], [y, y, -y, -y]])
-                transformed_corners = rotation.dot(corners) + translation
-                transformed_corners = transformed_corners.T.astype(int)
-                cv2.fillPoly(image, pts=[transformed_corners], color=shape.color)
-            elif isinstance(shape, context.Circle):
-                center = (int(shape.center.x), int(shape.center.y))
-                image = cv2.circle(image, center, int(shape.radius), color=shape.color, thickness=-1)
-            elif isinstance(shape, context.Text):
-                center = (int(shape.center.x), int(shape.center.y))
-                image = cv2.putText(
-                    image,
-                    shape.content,
-                    center,
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    shape.size,
-                    shape.color,
-                    3,
-                    cv2.LINE_AA,
+        if image is not None:
+            self._frame = None
+            image = np.ascontiguousarray(image)
+            self._draw_context(image, ctx)
+            self._count_redraw(image.shape[0] * image.shape[1])
+            self._display_frame(image)
+            return
+
+        if self._frame is None or self._last_ctx is not ctx:
+            self._frame = np.zeros((self.height, self.width, 3), np.uint8)
+            self._last_ctx = ctx
+            dirty = None
+        else:
+            dirty = self._dirty_rects(ctx)
+
+        frame_pixels = self.width * self.height
+        full = dirty is None
+        if dirty is not None:
+            rects = ctx.rect_buffer.data
+            circles = ctx.circle_buffer.data
+            corners = rect_corners(rects["x"], rects["y"], rects["width"], rects["height"], rects["rotation"])
+            rect_bounds = self._rect_bounds(corners)
+            circle_bounds = self._circle_bounds(circles)
+            other_bounds = np.array([self._bounds(shape) for _, shape in ctx.others], int).reshape(-1, 4)
+            tiles = []
+            for region in dirty:
+                hits = [self._overlapping(bounds, *region) for bounds in (rect_bounds, circle_bounds, other_bounds)]
+                # OpenCV draws a polygon or text cut by the edge of an image a
+                # little differently, so grow the tile to hold them whole
+                grown = np.vstack([[region], rect_bounds[hits[0]], other_bounds[hits[2]]])
+                box = [
+                    max(grown[:, 0].min(), 0), max(grown[:, 1].min(), 0),
+                    min(grown[:, 2].max(), self.width), min(grown[:, 3].max(), self.height),
+                ]
+                tiles.append((region, box, hits))
+            full = sum((x2 - x1) * (y2 - y1) for _, (x1, y1, x2, y2), _ in tiles) > self.full_redraw_fraction * frame_pixels
+
+        if full:
+            self._frame[:] = 0
+            self._draw_context(self._frame, ctx)
+            self._count_redraw(frame_pixels)
+        else:
+            redrawn = 0
+            orders = (rects["order"].tolist(), circles["order"].tolist(), [order for order, _ in ctx.others])
+            for (x1, y1, x2, y2), (ox, oy, ox2, oy2), hits in tiles:
+                # OpenCV can't draw into a strided view, so draw into a tile
+                tile = np.zeros((oy2 - oy, ox2 - ox, 3), np.uint8)
+                items = sorted(
+                    (orders[kind][i], kind, i) for kind, hit in enumerate(hits) for i in hit.tolist()
                 )
-            elif isinstance(shape, context.Image):
-                file_image = cv2.imread(shape.filepath, cv2.IMREAD_UNCHANGED)
-                file_image = cv2.resize(file_image, (shape.width, shape.height))
-
-                y1 = int(shape.center.y - shape.height / 2)
-                y2 = int(y1 + file_image.shape[0])
-                x1 = int(shape.center.x - shape.width / 2)
-                x2 = int(x1 + file_image.shape[1])
-
-                rgba = cv2.cvtColor(file_image, cv2.COLOR_RGB2RGBA)
-                alpha_s = rgba[:, :, 3] / 255.0
-                alpha_l = 1.0 - alpha_s
-
-                image_save = image.copy()
-                for c in range(0, 3):
-                    try:
-                        image[y1:y2, x1:x2, c] = alpha_s * file_image[:, :, c] + alpha_l * image[y1:y2, x1:x2, c]
-                    except ValueError:
-                        image = image_save
-        
-        self._display_frame(image)
+                for _, kind, i in items:
+                    if kind == 0:
+                        cv2.fillPoly(tile, pts=[corners[i] - [ox, oy]], color=rects["color"][i].tolist())
+                    elif kind == 1:
+                        center = (int(circles["x"][i]) - ox, int(circles["y"][i]) - oy)
+                        cv2.circle(tile, center, int(circles["radius"][i]), color=circles["color"][i].tolist(), thickness=-1)
+                    else:
+                        self._draw_shape(tile, ctx.others[i][1], ox, oy)
+                self._frame[y1:y2, x1:x2] = tile[y1 - oy:y2 - oy, x1 - ox:x2 - ox]
+                redrawn += (y2 - y1) * (x2 - x1)
+            self._count_redraw(redrawn)
+
+        self._display_frame(self._frame)
+
+    def _count_redraw(self, pixels):
+        self.redrawn_fraction = pixels / (self.width * self.height)
+        self.redrawn_pixels += pixels
+        self.rendered_pixels += self.width * self.height
+
+    def _dirty_rects(self, ctx):
+        """Merged regions to redraw, or None to redraw the whole frame."""
+        bounds = []
+        for changes in ctx.changes():
+            rects = changes.rects
+            bounds.append(self._rect_bounds(
+                rect_corners(rects["x"], rects["y"], rects["width"], rects["height"], rects["rotation"])
+            ))
+            bounds.append(self._circle_bounds(changes.circles))
+            bounds.append(np.array([self._bounds(shape) for _, shape in changes.others], int).reshape(-1, 4))
+        rects = np.concatenate(bounds)
+        rects[:, [0, 2]] = rects[:, [0, 2]].clip(0, self.width)
+        rects[:, [1, 3]] = rects[:, [1, 3]].clip(0, self.height)
+        rects = rects[(rects[:, 0] < rects[:, 2]) & (rects[:, 1] < rects[:, 3])]
+        # Decide on a full redraw before merging, which gets slow for many
+        # rectangles. Overlaps are counted twice, erring towards a full redraw.
+        limit = self.full_redraw_fraction * self.width * self.height
+        area = ((rects[:, 2] - rects[:, 0]) * (rects[:, 3] - rects[:, 1])).sum()
+        if len(rects) > self.full_redraw_shapes or area > limit:
+            return None
+        return merge_rects(rects.tolist())
+
+    @staticmethod
+    def _rect_bounds(corners):
+        """Like _bounds, for N x 4 x 2 rectangle corners, as an N x 4 array."""
+        pad = 2
+        return np.concatenate([corners.min(axis=1) - pad, corners.max(axis=1) + pad + 1], axis=1).reshape(-1, 4)
+
+    @staticmethod
+    def _circle_bounds(circles):
+        """Like _bounds, for CIRCLE_DTYPE rows, as an N x 4 array."""
+        pad = 2
+        x, y, r = circles["x"], circles["y"], circles["radius"]
+        return np.stack([
+            (x - r).astype(int) - pad, (y - r).astype(int) - pad,
+            (x + r).astype(int) + pad + 1, (y + r).astype(int) + pad + 1,
+        ], axis=1).reshape(-1, 4)
+
+    @staticmethod
+    def _overlapping(bounds, x1, y1, x2, y2):
+        """Indices of the N x 4 bounds that overlap a region."""
+        return np.flatnonzero((bounds[:, 0] < x2) & (x1 < bounds[:, 2]) & (bounds[:, 1] < y2) & (y1 < bounds[:, 3]))
+
+    @staticmethod
+    def _rect_corners(shape):
+        return rect_corners(
+            np.array([shape.center.x], float), np.array([shape.center.y], float),
+            np.array([shape.width], float), np.array([shape.height], float),
+            np.array([shape.rotation], float),
+        )[0]
+
+    def _draw_context(self, image, ctx):
+        """Draw every shape in ctx onto image, in order.
+
+        Runs of rectangles and circles are read straight from the context's
+        buffers, with all rectangle corners computed in one go.
+        """
+        kinds = ctx.kinds()
+        if not len(kinds):
+            return
+        rects = ctx.rect_buffer.data
+        corners = rect_corners(rects["x"], rects["y"], rects["width"], rects["height"], rects["rotation"])
+        rect_colors = rects["color"].tolist()
+        circles = ctx.circle_buffer.data
+        circle_centers = np.stack([circles["x"], circles["y"]], axis=1).astype(int).tolist()
+        circle_radii = circles["radius"].astype(int).tolist()
+        circle_colors = circles["color"].tolist()
+
+        # Each run of same kind shapes is a contiguous slice of its buffer
+        starts = np.flatnonzero(np.diff(kinds)) + 1
+        next_index = [0, 0, 0]
+        for start, end in zip(np.append(0, starts).tolist(), np.append(starts, len(kinds)).tolist()):
+            kind = kinds[start]
+            first = next_index[kind]
+            last = first + end - start
+            next_index[kind] = last
+            if kind == 0:
+                # fillPoly with several polygons leaves their overlaps empty
+                for i in range(first, last):
+                    cv2.fillPoly(image, pts=[corners[i]], color=rect_colors[i])
+            elif kind == 1:
+                for i in range(first, last):
+                    cv2.circle(image, circle_centers[i], circle_radii[i], color=circle_colors[i], thickness=-1)
+            else:
+                for _, shape in ctx.others[first:last]:
+                    self._draw_shape(image, shape)
+
+    def _bounds(self, shape):
+        """Conservative [x1, y1, x2, y2] bounds of the pixels a shape touches."""
+        pad = 2  # Antialiasing and rounding
+        if isinstance(shape, context.Rectangle):
+            corners = self._rect_corners(shape)
+            x1, y1 = corners.min(axis=0)
+            x2, y2 = corners.max(axis=0)
+        elif isinstance(shape, context.Circle):
+            x1, x2 = shape.center.x - shape.radius, shape.center.x + shape.radius
+            y1, y2 = shape.center.y - shape.radius, shape.center.y + shape.radius
+        elif isinstance(shape, context.Text):
+            (w, h), baseline = cv2.getTextSize(shape.content, cv2.FONT_HERSHEY_SIMPLEX, shape.size, 3)
+            x1, x2 = shape.center.x, shape.center.x + w
+            y1, y2 = shape.center.y - h, shape.center.y + baseline
+            pad += 3  # Line thickness
+        else:
+            x1, x2 = shape.center.x - shape.width / 2, shape.center.x + shape.width / 2
+            y1, y2 = shape.center.y - shape.height / 2, shape.center.y + shape.height / 2
+        return [int(x1) - pad, int(y1) - pad, int(x2) + pad + 1, int(y2) + pad + 1]
+
+    def _draw_shape(self, image, shape, ox=0, oy=0):
+        """Draw a shape onto image, whose top left is at (ox, oy) in the frame."""
+        if isinstance(shape, context.Rectangle):
+            transformed_corners = self._rect_corners(shape) - [ox, oy]
+            cv2.fillPoly(image, pts=[transformed_corners], color=shape.color)
+        elif isinstance(shape, context.Circle):
+            center = (int(shape.center.x) - ox, int(shape.center.y) - oy)
+            cv2.circle(image, center, int(shape.radius), color=shape.color, thickness=-1)
+        elif isinstance(shape, context.Text):
+            center = (int(shape.center.x) - ox, int(shape.center.y) - oy)
+            cv2.putText(
+                image,
+                shape.content,
+                center,
+                cv2.FONT_HERSHEY_SIMPLEX,
+                shape.size,
+                shape.color,
+                3,
+                cv2.LINE_AA,
+            )
+        elif isinstance(shape, context.Image):
+            asset = self.assets.get(shape.filepath, shape.width, shape.height)
+            if asset is None:
+                return
+            premultiplied, alpha_inv = asset
+
+            x = int(shape.center.x - shape.width / 2) - ox
+            y = int(shape.center.y - shape.height / 2) - oy
+            composite(image, premultiplied, alpha_inv, x, y)
 
     def _display_frame(self, image):
         cv2.imshow(Renderer.WINDOW_TITLE, image)
@@ -16,13 +16,14 @@ class Renderer(renderer.Renderer):
     def show_calibration_markers(self):
         pass
 
-    def render(self, ctx):
+    def render(self, ctx, image=None):
         """Display the draw context as text.
 
         Useful (perhaps?) as a debugging tool.
 
         Args:
           ctx (context.DrawingContext): A context with shapes to draw
+          image (numpy.ndarray): ignored
         """
         for shape in ctx.shapes:
             if isinstance(shape, context.Rectangle):
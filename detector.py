@@ -0,0 +1,132 @@
+import cv2.aruco as aruco
+import numpy as np
+import numpy.typing as npt
+
+from typing import List, Optional, Tuple
+
+from context import merge_rects
+from snapshot import ArucoDict, Image
+
+
+Detection = Tuple[npt.NDArray[np.float32], npt.NDArray[np.int32]]
+
+
+def detect_markers(image:Image) -> Detection:
+    """Run AprilTag detection over an image.
+
+    Returns:
+      (corners, ids): N x 4 x 2 corners and N ids.
+    """
+    corners, ids, _ = aruco.detectMarkers(image, ArucoDict)
+    if ids is None:
+        return np.zeros((0, 4, 2), np.float32), np.zeros(0, np.int32)
+    return np.concatenate(corners).reshape(-1, 4, 2), ids.reshape(-1).astype(np.int32)
+
+
+class TrackingDetector:
+    """Marker detector that only scans around previously seen markers.
+
+    Most frames are searched only inside padded regions around where markers
+    were last found. The whole frame is scanned every full_scan_interval
+    frames, and whenever a tracked marker isn't found in its region, so new
+    markers are still picked up.
+
+    Args:
+        full_scan_interval (int): scan the whole frame at least this often
+        padding (float): region padding as a fraction of the marker's size
+        min_padding (int): minimum region padding in pixels
+    Attributes:
+        frames (int): frames detected so far
+        full_scans (int): frames on which the whole frame was scanned
+        scanned_fraction (float): fraction of the last frame's pixels scanned
+        scanned_pixels (int): pixels scanned over all frames
+        total_pixels (int): pixels in all frames
+    """
+
+    def __init__(self, full_scan_interval:int=30, padding:float=0.5, min_padding:int=20):
+        self.full_scan_interval = max(1, full_scan_interval)
+        self.padding = padding
+        self.min_padding = min_padding
+
+        self.frames = 0
+        self.full_scans = 0
+        self.scanned_fraction = 0.0
+        self.scanned_pixels = 0
+        self.total_pixels = 0
+
+        self._corners = np.zeros((0, 4, 2), np.float32)
+        self._ids = np.zeros(0, np.int32)
+        self._since_full_scan = 0
+
+    @property
+    def average_scanned_fraction(self):
+        """Fraction of all pixels seen so far that were actually scanned."""
+        return self.scanned_pixels / self.total_pixels if self.total_pixels else 0.0
+
+    def reset(self):
+        """Forget tracked markers so the next frame is a full scan."""
+        self._corners = np.zeros((0, 4, 2), np.float32)
+        self._ids = np.zeros(0, np.int32)
+
+    def regions(self, width:int, height:int) -> List[List[int]]:
+        """Padded, merged [x1, y1, x2, y2] search regions around tracked markers."""
+        if len(self._ids) == 0:
+            return []
+        lo = self._corners.min(axis=1)
+        hi = self._corners.max(axis=1)
+        pad = np.maximum((hi - lo).max(axis=1) * self.padding, self.min_padding)[:, None]
+        lo = np.clip(np.floor(lo - pad), 0, [width, height]).astype(int)
+        hi = np.clip(np.ceil(hi + pad), 0, [width, height]).astype(int)
+        rects = merge_rects(np.hstack([lo, hi]).tolist())
+        return [r for r in rects if r[2] > r[0] and r[3] > r[1]]
+
+    def _scan_regions(self, image:Image, rects:List[List[int]]) -> Detection:
+        found_corners = []
+        found_ids = []
+        for x1, y1, x2, y2 in rects:
+            corners, ids = detect_markers(image[y1:y2, x1:x2])
+            found_corners.append(corners + np.array([x1, y1], np.float32))
+            found_ids.append(ids)
+        return np.concatenate(found_corners), np.concatenate(found_ids)
+
+    def _lost_marker(self, ids:npt.NDArray[np.int32]) -> bool:
+        previous, previous_counts = np.unique(self._ids, return_counts=True)
+        current, current_counts = np.unique(ids, return_counts=True)
+        counts = dict(zip(current.tolist(), current_counts.tolist()))
+        return any(counts.get(i, 0) < c for i, c in zip(previous.tolist(), previous_counts.tolist()))
+
+    def detect(self, image:Image) -> Detection:
+        """Find markers in image.
+
+        Returns:
+          (corners, ids): N x 4 x 2 corners and N ids.
+        """
+        height, width = image.shape[:2]
+        frame_pixels = width * height
+        self.frames += 1
+        self.total_pixels += frame_pixels
+
+        scanned = 0
+        rects = []
+        if self._since_full_scan + 1 < self.full_scan_interval:
+            rects = self.regions(width, height)
+
+        detection:Optional[Detection] = None
+        if rects:
+            detection = self._scan_regions(image, rects)
+            scanned = sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in rects)
+            if self._lost_marker(detection[1]):
+                detection = None
+
+        if detection is None:
+            detection = detect_markers(image)
+            scanned += frame_pixels
+            self.full_scans += 1
+            self._since_full_scan = 0
+        else:
+            self._since_full_scan += 1
+
+        self.scanned_pixels += scanned
+        self.scanned_fraction = scanned / frame_pixels
+        self._corners, self._ids = detection
+        return detection
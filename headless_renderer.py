@@ -0,0 +1,33 @@
+import os
+
+import cv2
+
+import cv2_renderer
+
+
+class Renderer(cv2_renderer.Renderer):
+    """Renders like the CV2 renderer but without opening a window.
+
+    Frames are written to RENDER_OUTPUT_DIR as numbered PNGs, or discarded if
+    it isn't set. Useful on render servers, in CI and for throughput tests.
+    """
+
+    def __init__(self, width, height):
+        super().__init__(width, height)
+        self.output_dir = None
+        self.frames = 0
+
+    def configure(self, config):
+        self.output_dir = config.get("RENDER_OUTPUT_DIR")
+
+    def setup(self):
+        if self.output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+
+    def toggle_fullscreen(self):
+        pass
+
+    def _display_frame(self, image):
+        if self.output_dir:
+            cv2.imwrite(os.path.join(self.output_dir, "frame%06d.png" % self.frames), image)
+        self.frames += 1
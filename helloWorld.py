@@ -1,8 +1,5 @@
 import tinyland
 from MarkerProgram import UnknownMarker, RectangleMarker, MarkerProgram
-import numpy as np
-
-from context import Size
 
 unknown = UnknownMarker()
 programs = {
@@ -14,17 +11,14 @@ for program in programs.items():
     program[1].initialiseImage()
 
 def run(snap, image):
-    [rows, cols, _] = image.shape
     # Draw shapes to context based on data in snapshot
     for id, markers in snap.markers.items():
         program:MarkerProgram = unknown
         if id in programs:
             program = programs[id]
-        program.render(id)
+        program.update(id)
         for marker in markers:
-            prog_image = program.finaliseImage(marker.corners, Size(cols, rows))
-            prog_sum =( prog_image[:,:,0] + prog_image[:,:,1] + prog_image[:,:,2])>0
-            image = np.where( np.stack([prog_sum,prog_sum, prog_sum], axis=-1), prog_image, image)
+            program.compositeOnto(image, marker.corners)
 
     return image
 
@@ -0,0 +1,340 @@
+"""Run several Tinyland apps on one table, sharing one camera and detector.
+
+Each frame is captured and its markers detected once, then published to
+every app through shared memory. Each app runs in its own worker process
+and draws into its own DrawingContext, and the contexts are merged into
+one render pass. An app that misses the frame deadline keeps showing its
+last drawing, so one slow app doesn't hold up the others.
+
+Apps are modules with an app(snap, ctx) function, like pong.py, and an
+optional setup() function run once in the worker. render_direct functions
+aren't supported, since they draw on the image itself.
+
+Usage:
+  python3 ./host.py pong helloWorld
+"""
+import importlib
+import multiprocessing as mp
+import queue
+import sys
+import time
+import traceback
+
+import numpy as np
+import numpy.typing as npt
+import toml
+
+from multiprocessing import shared_memory
+from typing import Any, List, Optional, Tuple
+
+import context
+import pipeline
+import snapshot
+import timing
+import tinyland
+
+
+class MarkerBoard:
+    """The markers of the last few frames, in shared memory.
+
+    The writer fills slot seq % slots and stamps it with seq last, and
+    readers check the stamp before and after copying a slot out, so a slot
+    overwritten mid-read is noticed rather than returned torn.
+
+    Args:
+        slots (int): frames kept
+        max_markers (int): markers stored per frame, extras are dropped
+        name (str): shared memory to attach to, or None to create it
+    """
+
+    def __init__(self, slots:int=4, max_markers:int=256, name:Optional[str]=None):
+        self.slots = slots
+        self.max_markers = max_markers
+        self.dtype = np.dtype([
+            ("seq", "<i8"),
+            ("time", "<f8"),
+            ("count", "<i4"),
+            ("ids", "<i4", (max_markers,)),
+            ("corners", "<f4", (max_markers, 4, 2)),
+            ("raw_corners", "<f4", (max_markers, 4, 2)),
+        ])
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=slots * self.dtype.itemsize)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self.owner = name is None
+        self.records:Optional[npt.NDArray[Any]] = np.ndarray(slots, self.dtype, buffer=self._shm.buf)
+        if self.owner:
+            self.records["seq"] = -1
+
+    def spec(self) -> Tuple[int, int, str]:
+        """Arguments to attach to this board from another process."""
+        return (self.slots, self.max_markers, self._shm.name)
+
+    @classmethod
+    def attach(cls, spec:Tuple[int, int, str]) -> "MarkerBoard":
+        return cls(*spec)
+
+    def write(self, seq:int, markers:snapshot.MarkerSet, timestamp:float) -> None:
+        assert self.records is not None, "MarkerBoard is closed"
+        record = self.records[seq % self.slots]
+        record["seq"] = -1
+        count = min(markers.count, self.max_markers)
+        record["time"] = timestamp
+        record["count"] = count
+        record["ids"][:count] = markers.ids[:count]
+        record["corners"][:count] = markers.corners[:count]
+        record["raw_corners"][:count] = markers.raw_corners[:count]
+        record["seq"] = seq
+
+    def read(self, seq:int) -> Optional[snapshot.Snapshot]:
+        """The Snapshot published as seq, or None if it has been overwritten."""
+        assert self.records is not None, "MarkerBoard is closed"
+        record = self.records[seq % self.slots]
+        if record["seq"] != seq:
+            return None
+        count = int(record["count"])
+        markers = snapshot.MarkerSet(
+            record["ids"][:count].copy(),
+            record["corners"][:count].copy(),
+            record["raw_corners"][:count].copy(),
+        )
+        timestamp = float(record["time"])
+        if record["seq"] != seq:
+            return None
+        return snapshot.Snapshot.from_markers(None, markers, timestamp)
+
+    def close(self):
+        self.records = None
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+
+
+def _app_worker(
+    index:int, name:str, spec:Tuple[int, int, str], width:int, height:int, requests:Any, results:Any,
+) -> None:
+    """Run one app on each frame the host sends, and send back its drawing."""
+    module = importlib.import_module(name)
+    if hasattr(module, "setup"):
+        module.setup()
+    board = MarkerBoard.attach(spec)
+    last_tick:Optional[float] = None
+    try:
+        while True:
+            seq = requests.get()
+            if seq is None:
+                break
+            snap = board.read(seq)
+            if snap is None:
+                results.put((index, seq, None))
+                continue
+            ctx = context.DrawingContext(width, height)
+            now = time.monotonic()
+            ctx.dt = 0.0 if last_tick is None else now - last_tick
+            ctx.snapshot_age = now - snap.timestamp
+            last_tick = now
+            drawn:Optional[context.DrawingContext] = ctx
+            try:
+                module.app(snap, ctx)
+            except Exception:
+                traceback.print_exc()
+                drawn = None
+            results.put((index, seq, drawn))
+    finally:
+        board.close()
+
+
+class AppHost:
+    """Worker processes running apps on the frames published to them.
+
+    Args:
+        apps (list<str>): app module names
+        width, height (int): projector size
+        max_markers (int): markers shared per frame
+    Attributes:
+        missed (list<int>): frames each app was given but didn't finish by
+          the deadline
+    """
+
+    def __init__(self, apps:List[str], width:int, height:int, max_markers:int=256):
+        self.apps = apps
+        self.width = width
+        self.height = height
+        self.board = MarkerBoard(max_markers=max_markers)
+        self.seq = -1
+        self.missed = [0] * len(apps)
+        self._contexts:List[Optional[context.DrawingContext]] = [None] * len(apps)
+        self._busy = [False] * len(apps)
+        self._sent = [-1] * len(apps)
+        self._ctx = mp.get_context("spawn")
+        self._results:Any = self._ctx.Queue()
+        self._requests:List[Any] = []
+        self._processes:List[Any] = []
+
+    def start(self):
+        for i, name in enumerate(self.apps):
+            requests = self._ctx.Queue()
+            p = self._ctx.Process(
+                target=_app_worker,
+                args=(i, name, self.board.spec(), self.width, self.height, requests, self._results),
+                name="tinyland-app-%s" % name,
+                daemon=True,
+            )
+            p.start()
+            self._requests.append(requests)
+            self._processes.append(p)
+
+    def publish(self, snap:snapshot.Snapshot) -> None:
+        """Share a frame's markers and hand the frame to every idle app."""
+        self.seq += 1
+        self.board.write(self.seq, snap.markers, snap.timestamp)
+        for i, requests in enumerate(self._requests):
+            if not self._busy[i] and self._processes[i].is_alive():
+                requests.put(self.seq)
+                self._busy[i] = True
+                self._sent[i] = self.seq
+
+    def collect(self, deadline:float) -> List[context.DrawingContext]:
+        """Wait until every app given this frame has drawn, or until
+        time.monotonic() reaches deadline, and return the newest drawing of
+        each app.
+
+        Apps still busy with an earlier frame aren't waited for, but their
+        drawings are picked up as soon as they arrive.
+        """
+        # Take whatever is already waiting, including late drawings
+        while any(self._busy):
+            try:
+                self._receive(self._results.get_nowait())
+            except queue.Empty:
+                break
+        while any(busy and sent == self.seq for busy, sent in zip(self._busy, self._sent)):
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                self._receive(self._results.get(timeout=timeout))
+            except queue.Empty:
+                break
+        for i, busy in enumerate(self._busy):
+            if busy and self._sent[i] == self.seq:
+                self.missed[i] += 1
+        return [ctx for ctx in self._contexts if ctx is not None]
+
+    def _receive(self, result:Tuple[int, int, Optional[context.DrawingContext]]) -> None:
+        i, _, ctx = result
+        self._busy[i] = False
+        if ctx is not None:
+            self._contexts[i] = ctx
+
+    def close(self):
+        for requests in self._requests:
+            requests.put(None)
+        for p in self._processes:
+            p.join(timeout=2)
+            if p.is_alive():
+                p.terminate()
+        for q in self._requests + [self._results]:
+            q.cancel_join_thread()
+        self.board.close()
+
+
+# Frame loop options of tinyland.run that the host doesn't have
+UNSUPPORTED = ("RECORD_SNAPSHOTS", "RENDER_FPS", "RETAINED_RENDERING")
+
+
+def run(apps:List[str]) -> None:
+    """Like tinyland.run, but for several apps sharing the table."""
+    l = tinyland.Landscape()
+    l.load_config("./config.toml")
+    ignored = [key for key in UNSUPPORTED if l.projector.get(key)]
+    if l.projector.get("MARKER_POSITIONS", "raw") != "raw":
+        ignored.append("MARKER_POSITIONS")
+    if ignored:
+        print("host.py doesn't support %s, ignoring." % ", ".join(ignored))
+    headless = l.projector.get("HEADLESS", False)
+    width, height = l.projector["PROJECTOR_WIDTH"], l.projector["PROJECTOR_HEIGHT"]
+    debug_preview = tinyland.open_preview(l)
+    source = tinyland.open_source(l)
+    r = tinyland.open_renderer(l)
+
+    host = AppHost(apps, width, height, max_markers=l.projector.get("MAX_MARKERS", 256))
+    host.start()
+    # How long apps get to draw each frame before their last drawing is used
+    app_deadline = l.projector.get("APP_DEADLINE", 0.05)
+    draw_on_camera = l.projector.get("DRAW_ON_CAMERA", True)
+
+    max_frames = l.projector.get("MAX_FRAMES", 0)
+    max_seconds = l.projector.get("MAX_SECONDS", 0)
+    frames = 0
+    started = time.monotonic()
+
+    timer = timing.FrameTimer(enabled=l.projector.get("PROFILE", False), log_path=l.projector.get("PROFILE_LOG"))
+    timing.install(timer)
+    try:
+        while True:
+            timer.begin_frame()
+            if not headless:
+                with timer.span("keys"):
+                    tinyland.handle_keyevents(l, r)
+            if source is l:
+                snap = l.get_snapshot()
+            else:
+                with timer.span("source"):
+                    snap = source.get_snapshot()
+            # Detect before publishing, so detection is timed in its own span
+            snap.detect()
+            with timer.span("apps"):
+                host.publish(snap)
+            published = time.monotonic()
+
+            if debug_preview is not None:
+                with timer.span("debug"):
+                    if snap.frame is not None and debug_preview.due():
+                        lines = timer.overlay_lines() if l.projector.get("PROFILE_OVERLAY", True) else []
+                        frame, markers, src_corners = l.preview_inputs(snap)
+                        debug_preview.submit(frame, markers, src_corners, lines)
+                    debug_preview.show()
+
+            if l.projector.get("CALIBRATE"):
+                r.show_calibration_markers()
+            else:
+                with timer.span("apps"):
+                    contexts = host.collect(published + app_deadline)
+                ctx = context.DrawingContext(width, height)
+                for app_ctx in contexts:
+                    ctx.merge(app_ctx)
+                image = snap.projector_image if draw_on_camera else None
+                with timer.span("render"):
+                    r.render(ctx, image)
+            timer.end_frame()
+
+            frames += 1
+            if max_frames and frames >= max_frames:
+                break
+            if max_seconds and time.monotonic() - started >= max_seconds:
+                break
+    finally:
+        elapsed = time.monotonic() - started
+        print("Ran %s frames in %.1fs (%.1f FPS)" % (frames, elapsed, frames / elapsed if elapsed else 0))
+        for name, missed in zip(apps, host.missed):
+            if missed:
+                print("%s missed the deadline on %s frames" % (name, missed))
+        timer.close()
+        host.close()
+        if debug_preview is not None:
+            debug_preview.close()
+        if isinstance(source, pipeline.Pipeline):
+            source.close()
+        l.close()
+
+
+if __name__ == "__main__":
+    apps = sys.argv[1:]
+    if not apps:
+        config = toml.load("./config.toml")
+        apps = config.get("APPS", [])
+    if not apps:
+        raise SystemExit("Give the apps to run, e.g. python3 ./host.py pong helloWorld, or set APPS in config.toml.")
+    run(apps)
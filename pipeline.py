@@ -0,0 +1,326 @@
+import multiprocessing as mp
+import queue
+import time
+import traceback
+
+import numpy as np
+import numpy.typing as npt
+
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import detector
+import snapshot
+
+
+class FrameRing:
+    """Fixed number of frame slots in shared memory.
+
+    Each slot holds a camera frame, the frame warped to projector space and
+    the markers detected in it, so stages in different processes can pass a
+    slot index around instead of pickling images.
+
+    Args:
+        frame_shape (tuple): shape of a camera frame
+        image_shape (tuple): shape of a projector space image
+        slots (int): number of slots, which caps the frames in flight
+        max_markers (int): markers stored per slot, extras are dropped
+    """
+
+    def __init__(
+        self, frame_shape:Sequence[int], image_shape:Sequence[int], slots:int, max_markers:int,
+        names:Optional[List[str]]=None,
+    ):
+        self.frame_shape = tuple(frame_shape)
+        self.image_shape = tuple(image_shape)
+        self.slots = slots
+        self.max_markers = max_markers
+        self.owner = names is None
+        self._names = names
+        self._shms:List[shared_memory.SharedMemory] = []
+
+        self.frames = self._array((slots,) + self.frame_shape, np.uint8)
+        self.images = self._array((slots,) + self.image_shape, np.uint8)
+        self.ids = self._array((slots, max_markers), np.int32)
+        self.corners = self._array((slots, max_markers, 4, 2), np.float32)
+        self.raw_corners = self._array((slots, max_markers, 4, 2), np.float32)
+
+    def _array(self, shape:Tuple[int, ...], dtype:"npt.DTypeLike") -> "npt.NDArray[Any]":
+        """An array in the next shared memory block, created or attached."""
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if self._names is None:
+            shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        else:
+            shm = shared_memory.SharedMemory(name=self._names[len(self._shms)])
+        self._shms.append(shm)
+        return np.ndarray(shape, dtype, buffer=shm.buf)
+
+    def spec(self):
+        """Arguments to attach to this ring from another process."""
+        return (self.frame_shape, self.image_shape, self.slots, self.max_markers, [s.name for s in self._shms])
+
+    @classmethod
+    def attach(cls, spec):
+        return cls(*spec)
+
+    def write_markers(self, slot:int, markers:snapshot.MarkerSet) -> int:
+        count = min(int(markers.count), self.max_markers)
+        self.ids[slot, :count] = markers.ids[:count]
+        self.corners[slot, :count] = markers.corners[:count]
+        self.raw_corners[slot, :count] = markers.raw_corners[:count]
+        return count
+
+    def read_markers(self, slot:int, count:int) -> snapshot.MarkerSet:
+        # Markers are small, so copy them out and let the app keep them
+        return snapshot.MarkerSet(
+            self.ids[slot, :count].copy(),
+            self.corners[slot, :count].copy(),
+            self.raw_corners[slot, :count].copy(),
+        )
+
+    def close(self):
+        # Drop the views so the shared memory can be closed
+        self.frames = self.images = self.ids = self.corners = self.raw_corners = np.zeros(0)
+        for shm in self._shms:
+            shm.close()
+            if self.owner:
+                shm.unlink()
+        self._shms = []
+
+
+def _capture_stage(config, setup, control, free_slots, out, stop):
+    """Read camera frames and warp them into projector space."""
+    import tinyland
+
+    try:
+        l = tinyland.Landscape()
+        l.projector = config
+        l.initialize_camera()
+        frame = l.get_raw_frame()
+    except BaseException:
+        # Pipeline.start raises this in the main process
+        setup.put(traceback.format_exc())
+        raise
+    setup.put(None if frame is None else frame.shape)
+    spec = control.get()
+    if spec is None:
+        return
+    ring = FrameRing.attach(spec)
+
+    calibrate_requests = 0
+    calibrated = 0
+    seq = 0
+    try:
+        while not stop.is_set():
+            while True:
+                try:
+                    request = control.get_nowait()
+                except queue.Empty:
+                    break
+                if request is not None:
+                    calibrate_requests = request
+                    l.projector["CALIBRATE"] = True
+
+            try:
+                slot = free_slots.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            if frame is None:
+                frame = l.get_raw_frame()
+                if frame is None:
+                    break
+            # CLOCK_MONOTONIC is shared between processes
+            captured = time.monotonic()
+            if l.projector.get("CALIBRATE") and l.calibrate(frame):
+                calibrated = calibrate_requests
+            l.update_calibration()
+
+            ring.frames[slot] = frame
+            l.camera_to_projector_space(ring.frames[slot], dst=ring.images[slot])
+            out.put((seq, slot, {
+                "SRC_CORNERS": np.asarray(l.projector["SRC_CORNERS"]).tolist(),
+                "calibrated": calibrated,
+                "captured": captured,
+                "homography": l.calibration.homography,
+                "inverse": l.calibration.inverse,
+            }))
+            seq += 1
+            frame = None
+    finally:
+        out.put(None)
+        ring.close()
+        l.close()
+
+
+def _detect_stage(config, spec, inp, out, stop):
+    """Find markers in warped frames and store them alongside the frame."""
+    ring = FrameRing.attach(spec)
+    tracker = None
+    if config.get("TRACK_MARKERS"):
+        tracker = detector.TrackingDetector(
+            full_scan_interval=config.get("FULL_SCAN_INTERVAL", 30),
+            padding=config.get("TRACK_PADDING", 0.5),
+        )
+    on_video = config["IDENTIFY_ON_VIDEO"]
+    try:
+        while True:
+            item = inp.get()
+            if item is None or stop.is_set():
+                break
+            seq, slot, meta = item
+            image = ring.frames[slot] if on_video else ring.images[slot]
+            if tracker is not None:
+                corners, ids = tracker.detect(image)
+            else:
+                corners, ids = detector.detect_markers(image)
+            H = meta["homography"] if on_video else meta["inverse"]
+            markers = snapshot.markers_from_detection(corners, ids, H, on_image=not on_video)
+            out.put((seq, slot, meta, ring.write_markers(slot, markers)))
+    finally:
+        out.put(None)
+        ring.close()
+
+
+class Pipeline:
+    """Run capture, warp and detection in worker processes.
+
+    The capture stage reads and warps frames, the detection stage finds
+    markers, and the main process runs the app and renderer, so throughput is
+    set by the slowest stage rather than the sum of them. Frames move between
+    stages through a FrameRing in shared memory. The ring has depth slots, so
+    at most depth frames are in flight, which caps the added latency.
+
+    The camera is opened by the capture process, not by the Landscape.
+
+    Args:
+        landscape (tinyland.Landscape): landscape whose config drives the
+          pipeline. Its CALIBRATE and SRC_CORNERS are kept in sync with the
+          capture process.
+        depth (int): number of frames in flight
+    """
+
+    def __init__(self, landscape:Any, depth:int=3):
+        if landscape.projector.get("CAMERAS"):
+            raise ValueError("PIPELINE only supports one camera, remove CAMERAS or PIPELINE from the config.")
+        self.landscape = landscape
+        self.depth = max(1, depth)
+        self.ring:Optional[FrameRing] = None
+        self._held:Optional[int] = None
+        self._last_seq = -1
+        self._calibrate_requests = 0
+        self._calibrating = False
+        self._processes:List[Any] = []
+
+        ctx = mp.get_context("spawn")
+        self._stop = ctx.Event()
+        self._setup:Any = ctx.Queue()
+        self._control:Any = ctx.Queue()
+        self._free:Any = ctx.Queue()
+        self._detect:Any = ctx.Queue()
+        self._results:Any = ctx.Queue()
+        self._ctx = ctx
+
+    def start(self):
+        config = dict(self.landscape.projector)
+        capture = self._ctx.Process(
+            target=_capture_stage,
+            args=(config, self._setup, self._control, self._free, self._detect, self._stop),
+            name="tinyland-capture",
+            daemon=True,
+        )
+        capture.start()
+        self._processes.append(capture)
+
+        frame_shape = self._wait_for_setup(capture)
+        if frame_shape is None:
+            self._control.put(None)
+            raise RuntimeError("Could not read a frame from the camera.")
+        image_shape = (config["PROJECTOR_HEIGHT"], config["PROJECTOR_WIDTH"]) + tuple(frame_shape[2:])
+        self.ring = FrameRing(frame_shape, image_shape, self.depth, config.get("MAX_MARKERS", 256))
+        self._control.put(self.ring.spec())
+
+        detect = self._ctx.Process(
+            target=_detect_stage,
+            args=(config, self.ring.spec(), self._detect, self._results, self._stop),
+            name="tinyland-detect",
+            daemon=True,
+        )
+        detect.start()
+        self._processes.append(detect)
+
+        for slot in range(self.depth):
+            self._free.put(slot)
+
+    def _wait_for_setup(self, capture:Any) -> Optional[Tuple[int, ...]]:
+        """The capture process's frame shape, or None if it got no frame.
+
+        Raises RuntimeError if the process failed or exited while opening the
+        camera, rather than waiting for it forever.
+        """
+        while True:
+            try:
+                result = self._setup.get(timeout=0.5)
+                break
+            except queue.Empty:
+                if not capture.is_alive():
+                    raise RuntimeError("The capture process exited with code %s while opening the camera." % capture.exitcode)
+        if isinstance(result, str):
+            raise RuntimeError("The capture process failed while opening the camera:\n%s" % result)
+        return None if result is None else tuple(result)
+
+    def _sync_calibration(self, meta:Dict[str, Any]) -> None:
+        # Calibration runs in the capture process; mirror its state here.
+        projector = self.landscape.projector
+        if self._calibrating and meta["calibrated"] == self._calibrate_requests:
+            self._calibrating = False
+            projector["CALIBRATE"] = False
+        if not self._calibrating:
+            projector["SRC_CORNERS"] = meta["SRC_CORNERS"]
+            if projector.get("CALIBRATE"):
+                self._calibrate_requests += 1
+                self._control.put(self._calibrate_requests)
+                self._calibrating = True
+
+    def get_snapshot(self) -> snapshot.Snapshot:
+        """Return the next frame in order, like Landscape.get_snapshot.
+
+        The Snapshot's frame and projector image are views into shared
+        memory that stay valid until the next call.
+        """
+        if self._held is not None:
+            self._free.put(self._held)
+            self._held = None
+
+        item = self._results.get()
+        if item is None:
+            raise SystemExit("Camera stopped producing frames.")
+        seq, slot, meta, count = item
+        assert seq > self._last_seq, "pipeline delivered frames out of order"
+        self._last_seq = seq
+        self._held = slot
+        self._sync_calibration(meta)
+
+        assert self.ring is not None, "Pipeline.start() wasn't called"
+        frame = self.ring.frames[slot]
+        image = self.ring.images[slot]
+        markers = self.ring.read_markers(slot, count)
+        source = frame if self.landscape.projector["IDENTIFY_ON_VIDEO"] else image
+        return snapshot.Snapshot.from_markers(source, markers, meta["captured"], frame=frame, projector_image=image)
+
+    def close(self):
+        """Stop the worker processes and free the shared memory."""
+        self._stop.set()
+        self._control.put(None)
+        # Unblock the capture stage and drain results so workers can exit
+        for slot in range(self.depth):
+            self._free.put(slot)
+        for p in self._processes:
+            p.join(timeout=2)
+            if p.is_alive():
+                p.terminate()
+        for q in (self._setup, self._control, self._free, self._detect, self._results):
+            q.cancel_join_thread()
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
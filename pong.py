@@ -26,16 +26,17 @@ class Paddle:
 
 
 class Ball:
-    def __init__(self, x, y, vx=15, vy=15, size=40):
+    # Velocities are in pixels per second, so speed doesn't depend on frame rate
+    def __init__(self, x, y, vx=450, vy=450, size=40):
         self.x = x
         self.y = y
         self.vx = vx
         self.vy = vy
         self.size = size
 
-    def update(self):
-        self.x += self.vx
-        self.y += self.vy
+    def update(self, dt):
+        self.x += self.vx * dt
+        self.y += self.vy * dt
 
     def render(self, ctx):
         ctx.rect(self.x, self.y, self.size, self.size)
@@ -62,28 +63,30 @@ def app(snap, ctx):
     # Draw shapes to context based on data in snapshot
     collide_ball()
 
-    for markers in snap.markers.values():
-        for marker in markers:
-            if marker.center.x < CONTEXT_WIDTH / 2:
-                player1.updateY(marker)
-            else:
-                player2.updateY(marker)
+    for marker in snap.markers_in_rect(0, 0, CONTEXT_WIDTH / 2, CONTEXT_HEIGHT):
+        player1.updateY(marker)
+    for marker in snap.markers_in_rect(CONTEXT_WIDTH / 2, 0, CONTEXT_WIDTH, CONTEXT_HEIGHT):
+        player2.updateY(marker)
     player1.render(ctx)
     player2.render(ctx)
 
-    ball.update()
+    ball.update(ctx.dt)
     ball.render(ctx)
 
     ctx.text(CONTEXT_WIDTH / 4, CONTEXT_HEIGHT / 4, str(player1.score))
     ctx.text(CONTEXT_WIDTH / 4 * 3, CONTEXT_HEIGHT / 4, str(player2.score))
 
 
-if __name__ == "__main__":
+def setup():
+    global player1, player2, ball
     player1 = Paddle(200, 10)
     player2 = Paddle(CONTEXT_WIDTH - 200, 10)  # Would be nice have access to projector width here :)
 
-    ball_vx = random.choice([15, -15])
-    ball_vy = random.choice([15, -15])
+    ball_vx = random.choice([450, -450])
+    ball_vy = random.choice([450, -450])
     ball = Ball(CONTEXT_WIDTH / 2, CONTEXT_HEIGHT / 2, ball_vx, ball_vy)
 
+
+if __name__ == "__main__":
+    setup()
     tinyland.run(app)
@@ -0,0 +1,125 @@
+import threading
+import time
+
+import cv2
+import numpy as np
+import numpy.typing as npt
+
+from typing import Any, Callable, List, Optional, Tuple
+
+import snapshot
+import timing
+
+
+# Image, markers, projection outline, overlay lines and scale of a frame to draw
+_Job = Tuple[snapshot.Image, snapshot.MarkerSet, "npt.NDArray[np.float64]", List[str], float]
+
+
+class DebugPreview:
+    """The Tinycam window, showing the camera frame with detected markers.
+
+    Only a frame every 1 / fps seconds is used. It is shrunk to `width` on
+    the calling thread, since the caller's frame buffer may be reused, and
+    markers, the projection outline and the profiling overlay are drawn on a
+    worker thread. If the worker is still busy the frame is skipped, so the
+    preview never holds up the frame loop. show() displays the newest
+    finished image and must be called from the main thread, as OpenCV's
+    windows require.
+
+    Args:
+        fps (float): preview update rate, 0 for every frame
+        width (int): preview width in pixels, 0 for the camera's width
+        on_mouse: optional cv2 mouse callback, given camera coordinates
+    Attributes:
+        skipped (int): due frames dropped because the worker was busy
+    """
+
+    WINDOW_TITLE = "Tinycam"
+
+    def __init__(self, fps:float=10.0, width:int=640, on_mouse:Optional[Callable[..., Any]]=None):
+        self.interval = 1.0 / fps if fps > 0 else 0.0
+        self.width = width
+        self.on_mouse = on_mouse
+        self.scale = 1.0
+        self.skipped = 0
+        self._next_update = 0.0
+        self._small:Optional[snapshot.Image] = None
+        self._job:Optional[_Job] = None
+        self._ready:Optional[snapshot.Image] = None
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._work, name="DebugPreview", daemon=True)
+
+    def setup(self):
+        cv2.namedWindow(DebugPreview.WINDOW_TITLE)
+        cv2.setMouseCallback(DebugPreview.WINDOW_TITLE, self._mouse)
+        self._thread.start()
+
+    def _mouse(self, event, x, y, flags, param):
+        if self.on_mouse is not None:
+            self.on_mouse(event, int(x / self.scale), int(y / self.scale), flags, param)
+
+    def due(self) -> bool:
+        """Whether a preview frame is due, so callers can skip preparing one
+        when it isn't. submit() may still skip it if the worker is busy."""
+        return time.monotonic() >= self._next_update
+
+    def submit(
+        self, frame:snapshot.Image, markers:snapshot.MarkerSet, src_corners:npt.ArrayLike,
+        lines:Optional[List[str]]=None,
+    ) -> None:
+        """Queue a frame for the preview, if one is due and the worker is free."""
+        if not self.due():
+            return
+        with self._cond:
+            if self._job is not None:
+                self.skipped += 1
+                return
+        self._next_update = time.monotonic() + self.interval
+
+        height, width = frame.shape[:2]
+        self.scale = min(1.0, self.width / width) if self.width else 1.0
+        if self.scale < 1.0:
+            size = (int(width * self.scale), int(height * self.scale))
+            self._small = cv2.resize(frame, size, dst=self._small, interpolation=cv2.INTER_AREA)
+            # The worker draws on its own copy so the buffer can be reused
+            small = self._small.copy()
+        else:
+            small = np.copy(frame)
+        with self._cond:
+            self._job = (small, markers, np.asarray(src_corners, float), lines or [], self.scale)
+            self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while self._job is None and self._running:
+                    self._cond.wait()
+                job = self._job
+                if not self._running or job is None:
+                    return
+                image, markers, src_corners, lines, scale = job
+
+            if markers.count:
+                corners = list((markers.raw_corners * scale).astype(np.float32)[:, None])
+                cv2.aruco.drawDetectedMarkers(image, corners, markers.ids)
+            cv2.polylines(image, pts=[(src_corners * scale).astype(int)], isClosed=True, color=(255, 255, 255))
+            timing.draw_lines(image, lines)
+
+            with self._cond:
+                self._ready = image
+                self._job = None
+
+    def show(self):
+        """Display the newest finished preview, if there is one."""
+        with self._cond:
+            image, self._ready = self._ready, None
+        if image is not None:
+            cv2.imshow(DebugPreview.WINDOW_TITLE, image)
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread.is_alive():
+            self._thread.join(timeout=1)
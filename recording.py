@@ -0,0 +1,157 @@
+import os
+import time
+
+import numpy as np
+import numpy.typing as npt
+
+from typing import Optional
+
+import snapshot
+
+
+MAGIC = b"TLSNAP01"
+HEADER_SIZE = 16
+
+# One record per marker, preceded by one record with id -1 per frame so that
+# frames without markers still have a timestamp.
+RECORD = np.dtype([
+    ("frame", "<u4"),
+    ("id", "<i4"),
+    ("time", "<f8"),
+    ("corners", "<f4", (4, 2)),
+    ("raw_corners", "<f4", (4, 2)),
+])
+FRAME_ID = -1
+
+
+class SnapshotRecorder:
+    """Append each frame's detected markers to a compact binary log.
+
+    The log is a short header followed by fixed-width RECORDs, so it can be
+    memory-mapped by SnapshotLog. Times are the Snapshots' time.monotonic()
+    capture times, so only the differences between them mean anything.
+
+    Args:
+        path (str): file to write, replaced if it exists
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+        self.frames = 0
+        self._file = open(path, "wb")
+        self._file.write(MAGIC.ljust(HEADER_SIZE, b"\0"))
+
+    def write(self, snap:snapshot.Snapshot, timestamp:Optional[float]=None) -> None:
+        """Append snap's markers, stamped with its capture time unless
+        timestamp is given."""
+        markers = snap.markers
+        records = np.zeros(markers.count + 1, RECORD)
+        records["frame"] = self.frames
+        records["time"] = snap.timestamp if timestamp is None else timestamp
+        records["id"][0] = FRAME_ID
+        records["id"][1:] = markers.ids
+        records["corners"][1:] = markers.corners
+        records["raw_corners"][1:] = markers.raw_corners
+        self._file.write(records.tobytes())
+        self.frames += 1
+
+    def close(self):
+        self._file.close()
+
+
+class SnapshotLog:
+    """Memory-mapped view of a log written by SnapshotRecorder.
+
+    Args:
+        path (str): log file to read
+    Attributes:
+        timestamps (numpy.ndarray): capture time of each frame
+
+    A log cut short, e.g. by a crash mid-write, is read up to its last whole
+    record.
+    """
+
+    def __init__(self, path:str):
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a snapshot log" % path)
+        count = max(0, os.path.getsize(path) - HEADER_SIZE) // RECORD.itemsize
+        self.records:npt.NDArray[np.void]
+        if count:
+            self.records = np.memmap(path, RECORD, mode="r", offset=HEADER_SIZE, shape=(count,))
+        else:
+            self.records = np.zeros(0, RECORD)
+        # Start of each frame's records, plus the end of the last frame
+        starts = np.flatnonzero(self.records["id"] == FRAME_ID)
+        self._bounds = np.append(starts, len(self.records))
+        self.timestamps = np.array(self.records["time"][starts])
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def markers(self, index:int) -> snapshot.MarkerSet:
+        start, end = self._bounds[index] + 1, self._bounds[index + 1]
+        records = self.records[start:end]
+        return snapshot.MarkerSet(
+            np.array(records["id"]),
+            np.array(records["corners"]),
+            np.array(records["raw_corners"]),
+        )
+
+
+class ReplaySource:
+    """Feed recorded Snapshots to tinyland.run without a camera or detector.
+
+    Has the same get_snapshot() as Landscape. The projector space image is
+    blank and there is no camera frame. Snapshots are stamped with their
+    recorded capture times, moved onto this run's clock so that the first
+    frame played is stamped as it's returned, and scaled by speed.
+
+    Args:
+        path (str): log written by SnapshotRecorder
+        width, height (int): projector size, for the blank image
+        speed (float): playback speed relative to the recording, or 0 to
+          replay as fast as possible
+        loop (bool): start again after the last frame instead of stopping
+    """
+
+    def __init__(self, path:str, width:int, height:int, speed:float=0.0, loop:bool=True):
+        self.log = SnapshotLog(path)
+        if not len(self.log):
+            raise ValueError("%s has no recorded frames to replay" % path)
+        self.width = width
+        self.height = height
+        self.speed = speed
+        self.loop = loop
+        self.index = 0
+        self._clock_start:Optional[float] = None
+        self._log_start = 0.0
+
+    def seek(self, index:int) -> None:
+        """Make frame `index` the next one returned."""
+        if not 0 <= index < len(self.log):
+            raise IndexError("frame %s not in a log of %s frames" % (index, len(self.log)))
+        self.index = index
+        self._clock_start = None
+
+    def get_snapshot(self):
+        if self.index >= len(self.log):
+            if not self.loop:
+                raise SystemExit("End of snapshot log.")
+            self.seek(0)
+
+        # This frame's time, relative to the first one played
+        now = time.monotonic()
+        if self._clock_start is None:
+            self._clock_start = now
+            self._log_start = float(self.log.timestamps[self.index])
+        timestamp = self._clock_start + (float(self.log.timestamps[self.index]) - self._log_start) / (self.speed or 1.0)
+        if self.speed > 0 and timestamp > now:
+            time.sleep(timestamp - now)
+
+        image = np.zeros((self.height, self.width, 3), np.uint8)
+        snap = snapshot.Snapshot.from_markers(
+            image, self.log.markers(self.index), timestamp=timestamp, projector_image=image,
+        )
+        self.index += 1
+        return snap
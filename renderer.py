@@ -4,6 +4,10 @@ from abc import ABC
 class Renderer(ABC):
     """Abstract base class for a Tinyland renderer."""
 
+    def configure(self, config):
+        """Read any renderer specific settings from the Tinyland config."""
+        pass
+
     def setup(self):
         pass
 
@@ -13,5 +17,5 @@ class Renderer(ABC):
     def show_calibration_markers(self):
         pass
 
-    def render(self, ctx):
+    def render(self, ctx, image=None):
         pass
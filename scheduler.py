@@ -0,0 +1,75 @@
+import threading
+
+from typing import Any, Optional, Tuple
+
+import snapshot
+import timing
+
+
+class DetectionLoop:
+    """Produce Snapshots on a background thread as fast as the source allows.
+
+    The render loop picks up the latest result with latest() at its own
+    rate, so a slow detector no longer holds back the projector. Markers are
+    detected on this thread, and the frame of each result is copied, since
+    sources like Pipeline and ThreadedCapture reuse their buffers on the
+    next call.
+
+    Args:
+        source: anything with get_snapshot() returning a Snapshot, e.g. a
+          Landscape, Pipeline or ReplaySource
+        profile (bool): time the source's spans on this thread's own
+          FrameTimer rather than the render loop's
+    Attributes:
+        timer (timing.FrameTimer): timings of each detection
+        seq (int): number of Snapshots produced so far
+    """
+
+    def __init__(self, source:Any, profile:bool=False):
+        self.source = source
+        self.timer = timing.FrameTimer(enabled=profile)
+        self.seq = 0
+        self._latest:Optional[snapshot.Snapshot] = None
+        self._error:Optional[BaseException] = None
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = threading.Thread(target=self._run, name="DetectionLoop", daemon=True)
+
+    def start(self):
+        self._running = True
+        self._thread.start()
+
+    def _run(self):
+        timing.install(self.timer, this_thread=True)
+        try:
+            while self._running:
+                self.timer.begin_frame()
+                result = self.source.get_snapshot().detach()
+                self.timer.end_frame()
+                with self._cond:
+                    self._latest = result
+                    self.seq += 1
+                    self._cond.notify_all()
+        except BaseException as e:
+            # SystemExit included, e.g. at the end of a replay
+            with self._cond:
+                self._error = e
+                self._cond.notify_all()
+
+    def latest(self) -> Tuple[snapshot.Snapshot, int]:
+        """Return the newest (snap, seq), waiting only for the first.
+
+        Re-raises anything the source raised, such as SystemExit at the end
+        of a replay.
+        """
+        with self._cond:
+            while self._latest is None and self._error is None:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+            assert self._latest is not None
+            return self._latest, self.seq
+
+    def stop(self):
+        self._running = False
+        self._thread.join(timeout=1)
@@ -1,14 +1,18 @@
+import cv2
 import cv2.aruco as aruco
 from collections import namedtuple
 import numpy as np
 import numpy.typing as npt
+import time
 
-from typing import Dict, List, Union
+from typing import Any, Callable, Dict, ItemsView, Iterator, List, Mapping, Optional, Tuple, Union, ValuesView
+
+import timing
 
 
 # Convenience class that allows indexing as well as x and y attribute access
 XYPoint = namedtuple("XYPoint", ["x", "y"])
-Image = npt.NDArray[int]
+Image = npt.NDArray[np.uint8]
 Corners = npt.NDArray[int]
 
 ArucoDict = aruco.getPredefinedDictionary(aruco.DICT_APRILTAG_36H11)
@@ -21,6 +25,26 @@ def transform(H, pt):
     return np.array([pt2[0,0], pt2[1,0]], dtype=pt.dtype)
 
 
+def transform_corners(H, corners):
+    """Apply the homography H to an N x 4 x 2 array of marker corners at once."""
+    if len(corners) == 0:
+        return corners.copy()
+    points = corners.reshape(-1, 1, 2)
+    return cv2.perspectiveTransform(points, H.astype(np.float64)).reshape(corners.shape).astype(corners.dtype)
+
+
+def marker_centers(corners):
+    """Centers of an N x 4 x 2 array of marker corners."""
+    return (corners[:, 0] + corners[:, 3]) / 2
+
+
+def marker_rotations(corners):
+    """Rotations in degrees of an N x 4 x 2 array of marker corners."""
+    delta = corners[:, 0] - corners[:, 2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.degrees(np.arctan(delta[:, 1] / delta[:, 0]))
+
+
 class Marker:
     """Base class for any detected physical objects.
 
@@ -36,8 +60,12 @@ center (XYPoint): center point of marker
 
 
 class ArucoMarker(Marker):
-    def __init__(self, id, corners, raw_corners):
-        [center_x, center_y] = np.median([np.array(corners[0,0]), np.array(corners[0,3])], axis=0)
+    def __init__(self, id, corners, raw_corners, center=None, rotation=None):
+        if center is None:
+            center = marker_centers(corners)[0]
+        if rotation is None:
+            rotation = marker_rotations(corners)[0]
+        [center_x, center_y] = center
         super().__init__(center_x, center_y)
         self.id = int(id)
         self.tl = XYPoint(*corners[0,0])
@@ -46,50 +74,491 @@ class ArucoMarker(Marker):
         self.br = XYPoint(*corners[0,3])
         self.corners = corners
         self.raw_corners = raw_corners
-        self.rotation = np.degrees(np.arctan((self.tl.y - self.bl.y) / (self.tl.x - self.bl.x)))
+        self.rotation = rotation
+
+
+class MarkerView:
+    """Per-marker view into a MarkerSet, with the same attributes as ArucoMarker.
+
+Attributes are read from the MarkerSet arrays on access, so creating a view
+costs a single small object.
+"""
+
+    __slots__ = ("_set", "_index")
+
+    def __init__(self, marker_set, index):
+        self._set = marker_set
+        self._index = index
+
+    @property
+    def id(self):
+        return int(self._set.ids[self._index])
+
+    @property
+    def center(self):
+        return self._set.center_points()[self._index]
+
+    @property
+    def tl(self):
+        return XYPoint(*self._set.corners[self._index, 0].tolist())
+
+    @property
+    def tr(self):
+        return XYPoint(*self._set.corners[self._index, 1].tolist())
+
+    @property
+    def bl(self):
+        return XYPoint(*self._set.corners[self._index, 2].tolist())
+
+    @property
+    def br(self):
+        return XYPoint(*self._set.corners[self._index, 3].tolist())
+
+    @property
+    def corners(self):
+        return self._set.corners[self._index:self._index + 1]
+
+    @property
+    def raw_corners(self):
+        return self._set.raw_corners[self._index:self._index + 1]
+
+    @property
+    def rotation(self):
+        return float(self._set.rotations[self._index])
+
+
+class MarkerGrid:
+    """Uniform grid over marker centers for region and nearest-marker queries.
+
+Markers are bucketed into square cells, about one marker per cell, with
+the markers of each row of cells stored contiguously, so a query only
+looks at the cells it overlaps instead of every marker.
+
+Args:
+centers (numpy.ndarray): N x 2 marker centers
+cell (float): cell size in pixels, chosen from the marker density if not
+given
+"""
+
+    def __init__(self, centers:npt.ArrayLike, cell:Optional[float]=None):
+        self.centers = np.asarray(centers, np.float64).reshape(-1, 2)
+        n = len(self.centers)
+        self.origin = self.centers.min(axis=0) if n else np.zeros(2)
+        extent = self.centers.max(axis=0) - self.origin if n else np.zeros(2)
+        if cell is None:
+            # Bounded below so markers along a line don't make a huge grid
+            cell = max(np.sqrt(extent[0] * extent[1] / n) if n else 1.0, extent.max() / max(n, 1), 1.0)
+        self.cell = float(cell)
+        self.cols, self.rows = (extent // self.cell).astype(int) + 1
+
+        cells = ((self.centers - self.origin) // self.cell).astype(int)
+        keys = cells[:, 1] * self.cols + cells[:, 0]
+        self.order = np.argsort(keys, kind="stable")
+        # Markers in cell k are order[starts[k]:starts[k + 1]]
+        self.starts = np.searchsorted(keys[self.order], np.arange(self.cols * self.rows + 1))
+
+    def _cell(self, x:float, y:float) -> Tuple[int, int]:
+        return int((x - self.origin[0]) // self.cell), int((y - self.origin[1]) // self.cell)
+
+    def _candidates(self, cx1:int, cy1:int, cx2:int, cy2:int) -> npt.NDArray[np.intp]:
+        """Indices of markers in the cells from (cx1, cy1) to (cx2, cy2) inclusive."""
+        cx1, cx2 = max(cx1, 0), min(cx2, self.cols - 1)
+        cy1, cy2 = max(cy1, 0), min(cy2, self.rows - 1)
+        if cx1 > cx2 or cy1 > cy2:
+            return np.zeros(0, np.intp)
+        # Cells in a row are contiguous, so each row is one slice
+        rows = [self.order[self.starts[r * self.cols + cx1]:self.starts[r * self.cols + cx2 + 1]] for r in range(cy1, cy2 + 1)]
+        return np.concatenate(rows)
+
+    def in_rect(self, x1:float, y1:float, x2:float, y2:float) -> npt.NDArray[np.intp]:
+        """Indices of markers with x1 <= x < x2 and y1 <= y < y2, in detection order."""
+        if not len(self.centers) or x1 >= x2 or y1 >= y2:
+            return np.zeros(0, np.intp)
+        cx1, cy1 = self._cell(max(x1, self.origin[0]), max(y1, self.origin[1]))
+        cx2, cy2 = self._cell(min(x2, self.origin[0] + self.cols * self.cell), min(y2, self.origin[1] + self.rows * self.cell))
+        found = self._candidates(cx1, cy1, cx2, cy2)
+        x, y = self.centers[found, 0], self.centers[found, 1]
+        return np.sort(found[(x1 <= x) & (x < x2) & (y1 <= y) & (y < y2)])
+
+    def in_radius(self, x:float, y:float, radius:float) -> npt.NDArray[np.intp]:
+        """Indices of markers within radius of (x, y), nearest first."""
+        if not len(self.centers) or radius < 0:
+            return np.zeros(0, np.intp)
+        cx1, cy1 = self._cell(max(x - radius, self.origin[0]), max(y - radius, self.origin[1]))
+        cx2, cy2 = self._cell(
+            min(x + radius, self.origin[0] + self.cols * self.cell),
+            min(y + radius, self.origin[1] + self.rows * self.cell),
+        )
+        found = self._candidates(cx1, cy1, cx2, cy2)
+        distances = np.hypot(self.centers[found, 0] - x, self.centers[found, 1] - y)
+        inside = distances <= radius
+        found, distances = found.compress(inside), distances.compress(inside)
+        return found.take(np.argsort(distances, kind="stable"))
+
+    def nearest(self, x:float, y:float, k:int=1) -> npt.NDArray[np.intp]:
+        """Indices of the k markers nearest (x, y), nearest first."""
+        k = min(k, len(self.centers))
+        if k <= 0:
+            return np.zeros(0, np.intp)
+        cx, cy = self._cell(x, y)
+        # Smaller rings around a point off the grid hold no cells
+        ring = max(0, -cx, -cy, cx - (self.cols - 1), cy - (self.rows - 1))
+        while True:
+            found = self._candidates(cx - ring, cy - ring, cx + ring, cy + ring)
+            covers_grid = cx - ring <= 0 and cy - ring <= 0 and cx + ring >= self.cols - 1 and cy + ring >= self.rows - 1
+            if len(found) >= k:
+                distances = np.hypot(self.centers[found, 0] - x, self.centers[found, 1] - y)
+                best = np.argsort(distances, kind="stable")[:k]
+                # Everything within ring cells of (x, y) has been seen
+                if covers_grid or distances[best[-1]] <= ring * self.cell:
+                    return found.take(best)
+            ring += 1
+
+
+class MarkerSet(Mapping[int, List[MarkerView]]):
+    """Detected markers stored as contiguous arrays.
+
+Behaves like the dict<int, list<ArucoMarker>> that Snapshot.markers used to
+be, handing out MarkerView objects, while the arrays can be used directly by
+vectorized app code.
+
+Args:
+ids (numpy.ndarray): N marker ids
+corners (numpy.ndarray): N x 4 x 2 corners in projector space
+raw_corners (numpy.ndarray): N x 4 x 2 corners in camera space
+centers (numpy.ndarray): N x 2 marker centers, computed if not given
+rotations (numpy.ndarray): N marker rotations in degrees, computed if not
+given
+Attributes:
+ids, corners, raw_corners, centers, rotations: the arrays above
+"""
+
+    def __init__(self, ids, corners, raw_corners, centers=None, rotations=None):
+        self.ids = np.ascontiguousarray(ids, dtype=np.int32).reshape(-1)
+        self.corners = np.ascontiguousarray(corners).reshape(-1, 4, 2)
+        self.raw_corners = np.ascontiguousarray(raw_corners).reshape(-1, 4, 2)
+        self.centers = marker_centers(self.corners) if centers is None else np.ascontiguousarray(centers)
+        self.rotations = marker_rotations(self.corners) if rotations is None else np.ascontiguousarray(rotations)
+        self._groups:Optional[Dict[int, List[int]]] = None
+        self._center_points:Optional[List[XYPoint]] = None
+        self._views:Dict[int, List[MarkerView]] = {}
+        self._grid:Optional[MarkerGrid] = None
+
+    @classmethod
+    def empty(cls) -> "MarkerSet":
+        return cls(np.zeros(0, np.int32), np.zeros((0, 4, 2), np.float32), np.zeros((0, 4, 2), np.float32))
+
+    @property
+    def count(self) -> int:
+        """Total number of detected markers, counting repeated ids."""
+        return len(self.ids)
+
+    def _index(self) -> Dict[int, List[int]]:
+        if self._groups is None:
+            self._groups = {}
+            for i, marker_id in enumerate(self.ids.tolist()):
+                self._groups.setdefault(marker_id, []).append(i)
+        return self._groups
+
+    def center_points(self) -> List[XYPoint]:
+        """Marker centers as XYPoints, converted once for per-marker access."""
+        if self._center_points is None:
+            self._center_points = list(map(XYPoint._make, self.centers.tolist()))
+        return self._center_points
+
+    def indices(self, marker_id:int) -> List[int]:
+        """Indices into the arrays of every marker with the given id."""
+        return self._index().get(marker_id, [])
+
+    def __getitem__(self, marker_id:int) -> List[MarkerView]:
+        views = self._views.get(marker_id)
+        if views is None:
+            views = [MarkerView(self, i) for i in self._index()[marker_id]]
+            self._views[marker_id] = views
+        return views
+
+    def _all_views(self) -> Dict[int, List[MarkerView]]:
+        """Views of every marker grouped by id, in the order of iteration."""
+        index = self._index()
+        if len(self._views) < len(index):
+            views = self._views
+            self._views = {
+                marker_id: views.get(marker_id) or [MarkerView(self, i) for i in indices]
+                for marker_id, indices in index.items()
+            }
+        return self._views
+
+    def values(self) -> ValuesView[List[MarkerView]]:
+        # Build every view in one pass rather than looking each id up
+        return self._all_views().values()
+
+    def items(self) -> ItemsView[int, List[MarkerView]]:
+        return self._all_views().items()
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._index())
+
+    def __len__(self) -> int:
+        return len(self._index())
+
+    def __contains__(self, marker_id:object) -> bool:
+        return marker_id in self._index()
+
+    def all(self) -> List[MarkerView]:
+        """Views of every marker in detection order."""
+        return [MarkerView(self, i) for i in range(self.count)]
+
+    def grid(self) -> MarkerGrid:
+        """Spatial index over the marker centers, built on first use."""
+        if self._grid is None:
+            self._grid = MarkerGrid(self.centers)
+        return self._grid
+
+    def views(self, indices:npt.ArrayLike) -> List[MarkerView]:
+        """Views of the markers at the given indices."""
+        return [MarkerView(self, i) for i in np.asarray(indices).tolist()]
 
 
 class Snapshot:
     """Current state of physical markers on the landscape.
 
 Processes an image array and pulls out marker information for the user.
+Work is done on first use: markers are only detected when one of the
+marker attributes is read, and the camera frame is only warped into
+projector space when projector_image is read, or when detection needs it.
 
 Args:
 image (numpy.ndarray): A W x H x 3 matrix representing the image
-to process.
+to process. May be None when on_image is set and warp is given, to detect
+on the warped frame.
+homography (numpy.ndarray): 3x3 transform from the image to the other space
+on_image (bool): whether the image is already in projector space
+detector (detector.TrackingDetector): optional stateful detector to find
+markers with, instead of scanning the whole image
+timestamp (float): time.monotonic() when the image was captured, by
+default when the Snapshot is created
+frame (numpy.ndarray): the camera frame, if there is one
+warp (callable): function warping a camera frame into projector space
 Attributes:
-markers (dict<int, list<ArucoMarker>>): maps marker id to list of marker
-objects that match that id.
+markers (MarkerSet): maps marker id to list of marker objects that match
+that id, backed by arrays of every marker. Holds smoothed or predicted
+markers instead when MARKER_POSITIONS says so.
+raw_markers, smoothed_markers, predicted_markers (MarkerSet): markers as
+detected, filtered, and extrapolated to when the frame will be shown.
+All three are the detected markers unless MARKER_POSITIONS is set.
+timestamp (float): time.monotonic() when the image was captured
+frame (numpy.ndarray): the camera frame, or None
+image (numpy.ndarray): the image markers are detected in
+projector_image (numpy.ndarray): the camera frame in projector space
+cameras (list<Snapshot>): with several cameras, each camera's Snapshot that
+this one's markers were merged from, otherwise empty
 """
 
-    def __init__(self, image, homography, on_image=False):
-        self.image = image
-        self.markers = self.detect_aruco(homography, on_image)
+    def __init__(
+        self, image:Optional[Image], homography:Optional[npt.NDArray[np.float64]], on_image:bool=False,
+        detector:Any=None, timestamp:Optional[float]=None,
+        frame:Optional[Image]=None, warp:Optional[Callable[[Image], Image]]=None,
+    ):
+        self.detector = detector
+        self.timestamp = time.monotonic() if timestamp is None else timestamp
+        self.frame = frame
+        self._image = image
+        self._homography = homography
+        self._on_image = on_image
+        self._warp = warp
+        self._projector_image:Optional[Image] = image if on_image else None
+        self._raw_markers:Optional[MarkerSet] = None
+        self._markers:Optional[MarkerSet] = None
+        self._smoothed_markers:Optional[MarkerSet] = None
+        self._predicted_markers:Optional[MarkerSet] = None
+        self.cameras:List[Snapshot] = []
+
+    @classmethod
+    def from_markers(
+        cls, image:Optional[Image], markers:MarkerSet, timestamp:Optional[float]=None,
+        frame:Optional[Image]=None, projector_image:Optional[Image]=None,
+        warp:Optional[Callable[[Image], Image]]=None,
+    ) -> "Snapshot":
+        """Create a Snapshot from markers that were already detected."""
+        snap = cls(image, None, timestamp=timestamp, frame=frame, warp=warp)
+        snap._projector_image = projector_image
+        snap._raw_markers = markers
+        return snap
+
+    @property
+    def image(self) -> Image:
+        if self._image is None:
+            return self.projector_image
+        return self._image
+
+    @property
+    def projector_image(self) -> Image:
+        if self._projector_image is None:
+            if self._warp is None or self.frame is None:
+                raise ValueError("Snapshot has no projector space image")
+            with timing.span("warp"):
+                self._projector_image = self._warp(self.frame)
+        return self._projector_image
+
+    @property
+    def raw_markers(self) -> MarkerSet:
+        if self._raw_markers is None:
+            if self._image is None:
+                # Detecting in projector space, so warp outside the detect span
+                self.warp()
+            with timing.span("detect"):
+                self._raw_markers = self.detect_aruco(self._homography, self._on_image)
+        return self._raw_markers
+
+    @property
+    def markers(self) -> MarkerSet:
+        return self.raw_markers if self._markers is None else self._markers
+
+    @markers.setter
+    def markers(self, markers:MarkerSet) -> None:
+        self._markers = markers
+
+    @property
+    def smoothed_markers(self) -> MarkerSet:
+        return self.raw_markers if self._smoothed_markers is None else self._smoothed_markers
 
-    def detect_aruco(self, H, on_image) -> Dict[int, List[ArucoMarker]]:
+    @smoothed_markers.setter
+    def smoothed_markers(self, markers:MarkerSet) -> None:
+        self._smoothed_markers = markers
+
+    @property
+    def predicted_markers(self) -> MarkerSet:
+        return self.raw_markers if self._predicted_markers is None else self._predicted_markers
+
+    @predicted_markers.setter
+    def predicted_markers(self, markers:MarkerSet) -> None:
+        self._predicted_markers = markers
+
+    def warp(self) -> Image:
+        """Warp the frame into projector space now, if that hasn't happened
+        yet, and return it."""
+        return self.projector_image
+
+    def detect(self) -> MarkerSet:
+        """Detect markers now, if that hasn't happened yet, and return them.
+
+        For timing detection on its own rather than inside whatever reads the
+        markers first.
+        """
+        return self.raw_markers
+
+    def detach(self) -> "Snapshot":
+        """Detect markers now and copy the frame and any warped image.
+
+        For passing the Snapshot to another thread, when the source will
+        reuse its buffers. The projector image is still warped lazily, from
+        the copied frame.
+        """
+        self.detect()
+        frame, projector_image = self.frame, self._projector_image
+        if frame is not None:
+            self.frame = np.copy(frame)
+        if projector_image is not None:
+            self._projector_image = np.copy(projector_image)
+        if self._image is frame:
+            self._image = self.frame
+        elif self._image is projector_image:
+            self._image = self._projector_image
+        elif self._image is not None:
+            self._image = np.copy(self._image)
+        return self
+
+    @property
+    def age(self) -> float:
+        """Seconds since the image was captured."""
+        return time.monotonic() - self.timestamp
+
+    def markers_in_rect(self, x1:float, y1:float, x2:float, y2:float) -> List[MarkerView]:
+        """Markers centered in the rectangle x1 <= x < x2, y1 <= y < y2."""
+        return self.markers.views(self.markers.grid().in_rect(x1, y1, x2, y2))
+
+    def markers_in_radius(self, x:float, y:float, radius:float) -> List[MarkerView]:
+        """Markers centered within radius of (x, y), nearest first."""
+        return self.markers.views(self.markers.grid().in_radius(x, y, radius))
+
+    def nearest(self, x:float, y:float, k:int=1) -> List[MarkerView]:
+        """The k markers centered nearest to (x, y), nearest first.
+
+        To find a marker's neighbours, ask for k + 1 and skip the marker itself.
+        """
+        return self.markers.views(self.markers.grid().nearest(x, y, k))
+
+    def detect_aruco(self, H:Optional[npt.NDArray[np.float64]], on_image:bool) -> MarkerSet:
         # Aruco - Find markers
-        aruco_markers = aruco.detectMarkers(self.image, ArucoDict)
-        corners = aruco_markers[0]
-        ids = aruco_markers[1]
-        markers:Dict[int, List[ArucoMarker]] = {}
-        if ids is None:
-            return markers
-        for aruco_id, corner in zip(ids, corners):
-            id_key = int(aruco_id[0])
-            [tl, tr, br, bl] = corner[0]
-            markers[id_key] = markers.get(id_key, [])
-            if on_image:
-                markers[id_key].append(ArucoMarker(id_key, 
-                    np.array([[tl,tr,br,bl]]),
-                    np.array([[transform(H,tl), transform(H,tr), 
-                        transform(H,br), transform(H,bl)]])
-                    )
-                )
-            else:
-                markers[id_key].append(ArucoMarker(id_key, 
-                    np.array([[transform(H,tl), transform(H,tr), 
-                        transform(H,br), transform(H,bl)]]),
-                    np.array([[tl,tr,br,bl]])
-                    )
-                )
-        return markers
+        if self.detector is not None:
+            corners, ids = self.detector.detect(self.image)
+        else:
+            corners, ids, _ = aruco.detectMarkers(self.image, ArucoDict)
+            if ids is not None:
+                corners = np.concatenate(corners)
+        return markers_from_detection(corners, ids, H, on_image)
+
+
+def merge_marker_sets(marker_sets:List[MarkerSet], distance:float) -> MarkerSet:
+    """Combine markers seen by several cameras into one MarkerSet.
+
+    Where cameras overlap, the same marker is seen more than once. Markers
+    with the same id from different cameras whose centers are within
+    distance pixels in projector space are counted once, keeping the one
+    that looked biggest to its camera.
+
+    Args:
+      marker_sets (list<MarkerSet>): markers from each camera, in projector
+        space. raw_corners stay in the space of the camera that saw them.
+      distance (float): how close in pixels duplicates are
+    """
+    ids = np.concatenate([m.ids for m in marker_sets])
+    if not len(ids):
+        return MarkerSet.empty()
+    corners = np.concatenate([m.corners for m in marker_sets])
+    raw_corners = np.concatenate([m.raw_corners for m in marker_sets])
+    centers = np.concatenate([m.centers for m in marker_sets])
+    rotations = np.concatenate([m.rotations for m in marker_sets])
+    cameras = np.repeat(np.arange(len(marker_sets)), [m.count for m in marker_sets])
+    # Shoelace area of each marker in its camera's pixels
+    x, y = raw_corners[:, :, 0], raw_corners[:, :, 1]
+    area = np.abs((x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y).sum(axis=1)) / 2
+
+    keep = np.ones(len(ids), bool)
+    order = np.lexsort((-area, ids))
+    sorted_ids = ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    ends = np.r_[starts[1:], len(ids)]
+    # Only ids seen more than once need looking at
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        if end - start < 2:
+            continue
+        group = order[start:end]
+        for i, marker in enumerate(group.tolist()):
+            if not keep[marker]:
+                continue
+            rest = group[i + 1:]
+            near = np.hypot(*(centers[rest] - centers[marker]).T) <= distance
+            keep[rest[near & (cameras[rest] != cameras[marker])]] = False
+    return MarkerSet(ids[keep], corners[keep], raw_corners[keep], centers[keep], rotations[keep])
+
+
+def markers_from_detection(
+    corners:npt.ArrayLike, ids:Optional[npt.NDArray[np.int32]],
+    H:Optional[npt.NDArray[np.float64]], on_image:bool,
+) -> MarkerSet:
+    """Build a MarkerSet from N x 4 x 2 corners found in an image.
+
+    Args:
+      corners (numpy.ndarray): corners in the detection image
+      ids (numpy.ndarray): marker ids, or None if nothing was found
+      H (numpy.ndarray): transform from the detection image to the other space
+      on_image (bool): whether the detection image is in projector space
+    """
+    if ids is None or len(ids) == 0:
+        return MarkerSet.empty()
+    raw = np.asarray(corners, np.float32).reshape(-1, 4, 2)
+    projected = transform_corners(H, raw)
+    if on_image:
+        raw, projected = projected, raw
+    return MarkerSet(ids, projected, raw)
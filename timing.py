@@ -0,0 +1,199 @@
+import csv
+import json
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+import numpy.typing as npt
+
+from typing import Any, ContextManager, Deque, Dict, List, Optional, Sequence, TextIO
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+# Keys of every frame record, which spans can't be named
+RESERVED = ("frame", "time", "total")
+# Stages timed by the frame loops, which get their own CSV columns. Any
+# others go in the last column as JSON.
+STAGES = (
+    "keys", "source", "capture", "cameras", "merge", "homography", "warp", "detect",
+    "debug", "tracking", "app", "apps", "render", "idle",
+)
+
+
+class _Span:
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class FrameTimer:
+    """Times named stages of each frame with a monotonic clock.
+
+    Keeps the last `window` frames of each stage for percentiles, can draw an
+    FPS and latency overlay, and can write a record per frame to a CSV or
+    JSON-lines file. CSV files have a column for each of STAGES, and a last
+    "other" column with any other stages as a JSON object. When disabled,
+    span() returns a shared no-op context manager so instrumented code costs
+    almost nothing.
+
+    Args:
+        enabled (bool): whether to record anything
+        window (int): number of frames kept for percentiles
+        log_path (str): optional .csv or .jsonl file to write frame records to
+    """
+
+    def __init__(self, enabled:bool=True, window:int=120, log_path:Optional[str]=None):
+        self.enabled = enabled
+        self.window = window
+        self.frames = 0
+        self.stages:Dict[str, Deque[float]] = {}
+        self.frame_times:Deque[float] = deque(maxlen=window)
+        self.current:Dict[str, float] = {}
+        self._frame_start:Optional[float] = None
+        self._log:Optional[TextIO] = None
+        self._csv:Optional[Any] = None
+        if enabled and log_path:
+            self._log = open(log_path, "w", newline="")
+            if not log_path.endswith(".jsonl"):
+                self._csv = csv.writer(self._log)
+                self._csv.writerow(RESERVED + STAGES + ("other",))
+
+    def span(self, name:str) -> ContextManager[Any]:
+        """Context manager adding the time spent inside it to stage `name`."""
+        if not self.enabled:
+            return _NO_SPAN
+        if name in RESERVED:
+            raise ValueError("%r is reserved, name the span something else" % name)
+        return _Span(self, name)
+
+    def add(self, name:str, seconds:float) -> None:
+        self.current[name] = self.current.get(name, 0.0) + seconds
+
+    def begin_frame(self):
+        if not self.enabled:
+            return
+        self._frame_start = time.perf_counter()
+        self.current = {}
+
+    def end_frame(self):
+        if not self.enabled or self._frame_start is None:
+            return
+        total = time.perf_counter() - self._frame_start
+        self.frame_times.append(total)
+        for name, seconds in self.current.items():
+            if name not in self.stages:
+                self.stages[name] = deque(maxlen=self.window)
+            self.stages[name].append(seconds)
+        if self._log is not None:
+            self._write_record(self._log, total)
+        self.frames += 1
+
+    def _write_record(self, log:TextIO, total:float) -> None:
+        if self._csv is None:
+            record:Dict[str, float] = {"frame": self.frames, "time": time.time(), "total": total}
+            record.update(self.current)
+            log.write(json.dumps(record) + "\n")
+            return
+        other = {name: seconds for name, seconds in self.current.items() if name not in STAGES}
+        self._csv.writerow(
+            [self.frames, time.time(), total]
+            + [self.current.get(name, "") for name in STAGES]
+            + [json.dumps(other) if other else ""]
+        )
+
+    @property
+    def fps(self) -> float:
+        if not self.frame_times:
+            return 0.0
+        return len(self.frame_times) / sum(self.frame_times)
+
+    def percentiles(self, name:str, qs:Sequence[float]=(50, 90, 99)) -> List[float]:
+        """Percentiles in seconds of a stage over the recent window."""
+        samples = self.frame_times if name == "total" else self.stages.get(name)
+        if not samples:
+            return [0.0 for _ in qs]
+        return [float(v) for v in np.percentile(np.fromiter(samples, float), qs)]
+
+    def summary(self) -> Dict[str, List[float]]:
+        """p50, p90 and p99 in seconds for every stage and the whole frame."""
+        result = {name: self.percentiles(name) for name in self.stages}
+        result["total"] = self.percentiles("total")
+        return result
+
+    def overlay_lines(self, title:str="") -> List[str]:
+        """FPS and per-stage median and p90 latency as lines of text."""
+        if not self.enabled:
+            return []
+        lines = [("%s " % title if title else "") + "%.1f FPS" % self.fps]
+        for name in self.stages:
+            p50, p90 = self.percentiles(name, (50, 90))
+            lines.append("%-10s %6.1f / %6.1f ms" % (name, p50 * 1000, p90 * 1000))
+        return lines
+
+    def draw_overlay(self, image:npt.NDArray[np.uint8], title:str="", top:int=25) -> int:
+        """Draw FPS and per-stage median and p90 latency onto image.
+
+        Returns:
+          the y coordinate below the last line, to draw more text at.
+        """
+        return draw_lines(image, self.overlay_lines(title), top)
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+def draw_lines(image:npt.NDArray[np.uint8], lines:List[str], top:int=25) -> int:
+    """Draw lines of overlay text onto image, returning the y below them."""
+    for i, line in enumerate(lines):
+        cv2.putText(image, line, (10, top + 22 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 1, cv2.LINE_AA)
+    return top + 22 * len(lines)
+
+
+timer = FrameTimer(enabled=False)
+_thread_timers = threading.local()
+
+
+def install(frame_timer:FrameTimer, this_thread:bool=False) -> None:
+    """Make frame_timer the one used by span().
+
+    With this_thread, only spans on the calling thread use it, so a loop on
+    another thread can time its own frames.
+    """
+    global timer
+    if this_thread:
+        _thread_timers.timer = frame_timer
+    else:
+        timer = frame_timer
+
+
+def span(name:str) -> ContextManager[Any]:
+    """Time a named span of the current frame, for use in apps.
+
+    Example:
+      with timing.span("physics"):
+          ball.update()
+    """
+    return getattr(_thread_timers, "timer", timer).span(name)
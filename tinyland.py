@@ -1,16 +1,25 @@
 import cv2
 import importlib
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import toml
 import sys
 import time
 
+import calibration
+import capture
 import context
+import detector
+import pipeline
+import preview
+import recording
+import scheduler
 import snapshot
+import timing
+import tracking
 
-from snapshot import Corners, Image
+from snapshot import Corners
 from typing import Dict, Any, Optional, List
-import numpy.typing as npt
 
 
 def squaritude(c):
@@ -28,52 +37,82 @@ class Landscape:
         self.camera:cv2.VideoCapture = None
         self.projector:Dict[str,Any] = {}
         self.homography = np.eye(3)
+        self.calibration = calibration.Calibration()
+        self.detector:Optional[detector.TrackingDetector] = None
+        self.calibration_candidates = 0
+        self._calibration_started:Optional[float] = None
+        self._calibration_reported = 0.0
+        # One Landscape per camera when CAMERAS is configured
+        self.cameras:List[Landscape] = []
+        self._camera_pool:Optional[ThreadPoolExecutor] = None
 
     def load_config(self, config_file):
-        self.projector = toml.load(config_file)
+        self.configure(toml.load(config_file))
         print(self.projector)
 
-    def camera_to_projector_space(self, image):
-        for i in range(5):
-            try:
-                image = cv2.warpPerspective(
-                    image,
-                    self.homography,
-                    (
-                        self.projector["PROJECTOR_WIDTH"],
-                        self.projector["PROJECTOR_HEIGHT"],
-                    ),
-                )
-                break
-            except cv2.error:
-                print("Warp perspective failed. Attempt #%s" % (i + 1))
-                time.sleep(1)
-                if i == 5:
-                    print("Warp perspective failed for good 😭. Exiting early.")
-                    sys.exit()
-
-        if self.projector["FLIP_PROJECTION"]:
-            image = cv2.flip(image, -1)
-        return image
+    def configure(self, projector:Dict[str, Any]) -> None:
+        self.projector = projector
+        if self.projector.get("TRACK_MARKERS"):
+            self.detector = detector.TrackingDetector(
+                full_scan_interval=self.projector.get("FULL_SCAN_INTERVAL", 30),
+                padding=self.projector.get("TRACK_PADDING", 0.5),
+            )
+
+    def update_calibration(self):
+        """Rebuild the cached homography and warp maps if the config changed."""
+        self.calibration.update(
+            np.array(self.projector["SRC_CORNERS"]),
+            np.array(self.projector["DEST_CORNERS"]),
+            self.projector["PROJECTOR_WIDTH"],
+            self.projector["PROJECTOR_HEIGHT"],
+            self.projector["FLIP_PROJECTION"],
+        )
+        self.homography = self.calibration.homography
+
+    def camera_to_projector_space(self, image, dst=None):
+        return self.calibration.warp(image, dst)
 
     def get_raw_frame(self):
+        if self.projector.get("CAMERAS"):
+            raise ValueError("With CAMERAS there is no single camera frame, use get_snapshot() instead.")
         frame = self.camera.read()[1]
 
         # If we're at the end of the video, rewind. This comes into play when we're using a video file as input, as for testing offline.
-        if frame is None and not self.projector["USE_CAMERA"]:
+        # A ThreadedCapture rewinds on its own producer thread.
+        if frame is None and not self.projector["USE_CAMERA"] and not isinstance(self.camera, capture.ThreadedCapture):
             self.camera.set(cv2.CAP_PROP_POS_MSEC, 0)
             frame = self.camera.read()[1]
 
         return frame
 
-    def find_corners(self, frame):
-        PROJECTOR_WIDTH = self.projector["PROJECTOR_WIDTH"]
-        PROJECTOR_HEIGHT = self.projector["PROJECTOR_HEIGHT"]
+    def preview_inputs(self, snap):
+        """The frame, markers and SRC_CORNERS to show in Tinycam for snap.
 
-        # Search for our calibration markers
-        frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        With several cameras, those of the first camera, whose frame is the
+        one shown, as the merged markers come from every camera.
+        """
+        if self.cameras and snap.cameras:
+            return snap.cameras[0].frame, snap.cameras[0].raw_markers, self.cameras[0].projector["SRC_CORNERS"]
+        return snap.frame, snap.raw_markers, self.projector["SRC_CORNERS"]
+
+    def close(self):
+        """Release the cameras."""
+        for camera in self.cameras:
+            camera.close()
+        self.cameras = []
+        if self._camera_pool is not None:
+            self._camera_pool.shutdown()
+            self._camera_pool = None
+        if self.camera is not None:
+            self.camera.release()
+            self.camera = None
+
+    def _find_marker_contours(self, frame_gray, offset=(0, 0)):
+        """Find contours that look like calibration markers in a grayscale image."""
         rv, frame_thresh = cv2.threshold(frame_gray, 185, 255, cv2.THRESH_BINARY)
-        contours, hierarchy = cv2.findContours(frame_thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        contours, hierarchy = cv2.findContours(frame_thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+        if hierarchy is None:
+            return []
         hierarchy = hierarchy[0]
 
         markers = []
@@ -95,18 +134,59 @@ class Landscape:
                     and area / child_area < 10
                     and area / child_area > 2
                 ):
-                    markers.append(i)
+                    markers.append(contours[i])
+        return markers
+
+    def find_corners(self, frame):
+        PROJECTOR_WIDTH = self.projector["PROJECTOR_WIDTH"]
+        PROJECTOR_HEIGHT = self.projector["PROJECTOR_HEIGHT"]
+
+        # Search for our calibration markers on a downscaled frame first, then
+        # only look at full resolution around the candidates.
+        frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        coarse = frame_gray
+        scale = 1
+        while coarse.shape[1] >= 2 * self.projector.get("CALIBRATION_SEARCH_WIDTH", 640):
+            coarse = cv2.pyrDown(coarse)
+            scale *= 2
+
+        if scale == 1:
+            markers = self._find_marker_contours(frame_gray)
+        else:
+            height, width = frame_gray.shape
+            regions = []
+            for c in self._find_marker_contours(coarse):
+                x, y, w, h = cv2.boundingRect(c)
+                pad = max(w, h) // 2 + 2
+                regions.append([
+                    max((x - pad) * scale, 0),
+                    max((y - pad) * scale, 0),
+                    min((x + w + pad) * scale, width),
+                    min((y + h + pad) * scale, height),
+                ])
+            markers = []
+            for x1, y1, x2, y2 in context.merge_rects(regions):
+                markers.extend(self._find_marker_contours(frame_gray[y1:y2, x1:x2], offset=(x1, y1)))
+        self.calibration_candidates = len(markers)
 
         if len(markers) == 4:
             # Assume we've found our markers - take a convex hull and check that it's a quadrilateral
             all_points = []
-            for c in [contours[i] for i in markers]:
+            for c in markers:
                 all_points.extend(c)
             boundary = cv2.convexHull(np.array(all_points))
             boundary = cv2.approxPolyDP(boundary, 25, True)
             # Not sure why this is necessary
             boundary = boundary[:, 0]
             if len(boundary) == 4:
+                # Refine the corners to subpixel accuracy
+                boundary = cv2.cornerSubPix(
+                    frame_gray,
+                    boundary.astype(np.float32).reshape(-1, 1, 2),
+                    (5, 5),
+                    (-1, -1),
+                    (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01),
+                )[:, 0]
                 # This has to be the dumbest possible way to sort four points clockwise from top left
                 point1 = [p for p in boundary if p[0] < PROJECTOR_WIDTH / 2 and p[1] < PROJECTOR_HEIGHT / 2]
                 point2 = [p for p in boundary if p[0] > PROJECTOR_WIDTH / 2 and p[1] < PROJECTOR_HEIGHT / 2]
@@ -118,7 +198,44 @@ class Landscape:
                     return final_corners
         return None
 
+    def calibrate(self, frame):
+        """Look for the calibration markers in frame and update SRC_CORNERS.
+
+        Reports progress about once a second, and gives up after
+        CALIBRATION_TIMEOUT seconds (default 30, 0 to keep trying).
+
+        Returns:
+          True once calibration has finished, found or timed out.
+        """
+        now = time.monotonic()
+        if self._calibration_started is None:
+            self._calibration_started = now
+            self._calibration_reported = now
+        elapsed = now - self._calibration_started
+
+        corners = self.find_corners(frame)
+        if corners is not None:
+            print("Calibrated in %.1fs." % elapsed)
+            self.projector["SRC_CORNERS"] = corners
+            self.projector["CALIBRATE"] = False
+            self._calibration_started = None
+            return True
+
+        if now - self._calibration_reported >= 1:
+            print("Calibrating... %s candidate markers (need exactly 4) after %.0fs." % (self.calibration_candidates, elapsed))
+            self._calibration_reported = now
+        timeout = self.projector.get("CALIBRATION_TIMEOUT", 30)
+        if timeout and elapsed > timeout:
+            print("Calibration markers not found after %ss, keeping the previous corners." % timeout)
+            self.projector["CALIBRATE"] = False
+            self._calibration_started = None
+            return True
+        return False
+
     def initialize_camera(self):
+        if self.projector.get("CAMERAS"):
+            self._initialize_cameras()
+            return
         if self.projector["USE_CAMERA"]:
             try:
                 # Grab camera from config
@@ -135,35 +252,105 @@ class Landscape:
             print("width: %s" % self.camera.get(cv2.CAP_PROP_FRAME_WIDTH))
             print("height: %s" % self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT))
             print("FPS: %s" % self.camera.get(cv2.CAP_PROP_FPS))
+        elif self.projector.get("FRAME_CACHE"):
+            self.camera = capture.FrameCache(
+                self.projector["VIDEO_FILE_PATH"],
+                cache_path=self.projector.get("FRAME_CACHE_PATH"),
+                max_frames=self.projector.get("FRAME_CACHE_MAX_FRAMES", 0),
+                pace=self.projector.get("FRAME_CACHE_PACE", False),
+            )
         else:
             self.camera = cv2.VideoCapture(self.projector["VIDEO_FILE_PATH"])
 
+        if self.projector.get("THREADED_CAPTURE"):
+            self.camera = capture.ThreadedCapture(
+                self.camera,
+                buffers=self.projector.get("CAPTURE_BUFFERS", 3),
+                rewind=not self.projector["USE_CAMERA"],
+                pace=not self.projector["USE_CAMERA"],
+            )
+
+    def _initialize_cameras(self):
+        """Open every camera in CAMERAS, each with its own Landscape.
+
+        Each entry of CAMERAS overrides the top level config for its camera,
+        e.g. VIDEO_CAPTURE_INDEX or VIDEO_FILE_PATH, SRC_CORNERS, and
+        DEST_CORNERS for the part of the projector space it sees.
+        """
+        for overrides in self.projector["CAMERAS"]:
+            camera = Landscape()
+            config = dict(self.projector)
+            del config["CAMERAS"]
+            config.update(overrides)
+            camera.configure(config)
+            camera.initialize_camera()
+            self.cameras.append(camera)
+        # Capture, warp and detection release the GIL, so threads run them in parallel
+        self._camera_pool = ThreadPoolExecutor(
+            len(self.cameras),
+            thread_name_prefix="camera",
+            initializer=timing.install,
+            initargs=(timing.FrameTimer(enabled=False), True),
+        )
+
+    def _get_merged_snapshot(self):
+        """Capture and detect on every camera at once, and merge the markers."""
+        if self.projector.get("CALIBRATE"):
+            print("Calibration isn't supported with several cameras, set SRC_CORNERS for each camera instead.")
+            self.projector["CALIBRATE"] = False
+        assert self._camera_pool is not None
+        with timing.span("cameras"):
+            # detach() detects markers, and copies frames which may be reused
+            snaps = list(self._camera_pool.map(lambda camera: camera.get_snapshot().detach(), self.cameras))
+        with timing.span("merge"):
+            markers = snapshot.merge_marker_sets([s.raw_markers for s in snaps], self.projector.get("DEDUP_DISTANCE", 20.0))
+
+        def combine_warped(_):
+            # Pixels a camera doesn't see warp to black
+            return np.maximum.reduce([s.projector_image for s in snaps])
+
+        merged = snapshot.Snapshot.from_markers(
+            None, markers, min(s.timestamp for s in snaps), frame=snaps[0].frame, warp=combine_warped,
+        )
+        merged.cameras = snaps
+        return merged
+
     def get_snapshot(self):
         """Process self.camera image into a Snapshot.
 
+        Markers are detected, and the frame warped into projector space, only
+        when the Snapshot's markers or projector_image are first read.
+
+        With several cameras, the Snapshot has the markers of all of them and
+        the first camera's frame.
+
         Returns:
           snap (snapshot.Snapshot): snapshot generated from self.camera image.
         """
-        SRC_CORNERS:Corners = np.array(self.projector["SRC_CORNERS"])
-        DEST_CORNERS:Corners = np.array(self.projector["DEST_CORNERS"])
-        frame = self.get_raw_frame()
-        if self.projector.get("CALIBRATE"):
-            corners = self.find_corners(frame)
-            if corners is not None:
-                SRC_CORNERS = corners
-                self.projector["SRC_CORNERS"] = corners
-                self.projector["CALIBRATE"] = False
-        self.homography, status = cv2.findHomography(SRC_CORNERS, DEST_CORNERS)
+        if self.cameras:
+            return self._get_merged_snapshot()
+        with timing.span("capture"):
+            frame = self.get_raw_frame()
+        if frame is None:
+            raise SystemExit("Camera stopped producing frames.")
+        # A ThreadedCapture may hand back a frame captured a little while ago
+        captured = time.monotonic() - getattr(self.camera, "frame_age", 0.0)
+        with timing.span("homography"):
+            if self.projector.get("CALIBRATE"):
+                self.calibrate(frame)
+            self.update_calibration()
+        # The frame may be warped later on another thread, after a recalibration
+        warp = self.calibration.warper()
 
         if self.projector["IDENTIFY_ON_VIDEO"]:
-            print('Identify on frame')
-            snap = snapshot.Snapshot(frame, self.homography, on_image=False)
-        image = self.camera_to_projector_space(frame)
-        if not self.projector["IDENTIFY_ON_VIDEO"]:
-            print('Identify on image')
-            snap = snapshot.Snapshot(image, np.linalg.inv(self.homography), on_image=True)
-
-        return snap, image, frame
+            return snapshot.Snapshot(
+                frame, self.homography, on_image=False, detector=self.detector, timestamp=captured,
+                frame=frame, warp=warp,
+            )
+        return snapshot.Snapshot(
+            None, self.calibration.inverse, on_image=True, detector=self.detector, timestamp=captured,
+            frame=frame, warp=warp,
+        )
 
 
 def printXY(_a, x, y, _b, _c):
@@ -233,7 +420,60 @@ def select_camera():
             cv2.imshow(SELECT_CAM_WINDOW, cameras[cur_index].read()[1])
 
 
-def run(render_ctx, render_direct):
+def open_preview(l:Landscape) -> Optional[preview.DebugPreview]:
+    """Open the Tinycam window, unless the config turns it off."""
+    if l.projector.get("HEADLESS", False) or not l.projector.get("PREVIEW", True):
+        return None
+    debug_preview = preview.DebugPreview(
+        fps=l.projector.get("PREVIEW_FPS", 10),
+        width=l.projector.get("PREVIEW_WIDTH", 640),
+        on_mouse=printXY,  # Useful when setting projection config.
+    )
+    debug_preview.setup()
+    return debug_preview
+
+
+def open_source(l:Landscape) -> Any:
+    """Start whatever the config says Snapshots come from.
+
+    Returns:
+      the Landscape itself, a Pipeline or a ReplaySource, all with
+      get_snapshot().
+    """
+    print("Initialising camera... ", end=None)
+    source:Any = l
+    if l.projector.get("REPLAY_SNAPSHOTS"):
+        # Replay recorded markers instead of using the camera and detector
+        source = recording.ReplaySource(
+            l.projector["REPLAY_SNAPSHOTS"],
+            l.projector["PROJECTOR_WIDTH"],
+            l.projector["PROJECTOR_HEIGHT"],
+            speed=l.projector.get("REPLAY_SPEED", 0.0),
+        )
+        source.seek(l.projector.get("REPLAY_START_FRAME", 0))
+    elif l.projector.get("PIPELINE"):
+        # Capture, warp and detection run in worker processes
+        source = pipeline.Pipeline(l, depth=l.projector.get("PIPELINE_DEPTH", 3))
+        source.start()
+    else:
+        l.initialize_camera()
+    print("Done")
+    return source
+
+
+def open_renderer(l:Landscape) -> Any:
+    """Import and set up the renderer named by the config."""
+    # Headless runs open no windows, so don't default to one
+    render_config = l.projector.get("RENDERER", "headless" if l.projector.get("HEADLESS", False) else "CV2")
+    render_mod = importlib.import_module(f"{render_config.lower()}_renderer")
+    # TODO: check that render_mod contains subclass definition of Renderer ABC
+    r = render_mod.Renderer(l.projector["PROJECTOR_WIDTH"], l.projector["PROJECTOR_HEIGHT"])
+    r.configure(l.projector)
+    r.setup()
+    return r
+
+
+def run(render_ctx, render_direct=None):
     """Run a user's app function that represents a Tinyland application.
 
     This function runs a setup procedure and then the app loop:
@@ -244,58 +484,187 @@ def run(render_ctx, render_direct):
          the Renderer.
     App Loop:
       1. Handle top-level Tinyland keyevent like calibration control and quit.
-      2. Grab a Snapshot from the Landscape.
+      2. Grab a Snapshot from the Landscape. With RENDER_FPS set, detection
+         runs on its own thread and this takes the newest Snapshot instead.
       3. Either:
           a. display calibration image
           b. create DrawingContext and run app function with Snapshot and Context.
-      4. Repeat.
+      4. Repeat, waiting for the next tick when RENDER_FPS is set.
+
+    The context's dt is the time since the app last ran and snapshot_age is
+    how long ago the Snapshot's frame was captured, so apps can animate at
+    the same speed whatever the frame rate.
 
     Args:
-      app: a function that takes a Snapshot and a Context, and writes shapes to
-        the context using its built in methods.
+      render_ctx: a function that takes a Snapshot and a Context, and writes
+        shapes to the context using its built in methods.
+      render_direct: optional function that takes a Snapshot and the projector
+        space image, and returns an image to draw the Context over.
     """
     # Setup
     l = Landscape()
     l.load_config("./config.toml")
-    cv2.namedWindow("Tinycam")
-    cv2.setMouseCallback("Tinycam", printXY)  # Useful when setting projection config.
-    print("Initialising camera... ", end=None)
-    l.initialize_camera()
-    print("Done")
-
-    render_config = l.projector.get("RENDERER", "CV2")
-    render_mod = importlib.import_module(f"{render_config.lower()}_renderer")
-    # TODO: check that render_mod contains subclass definition of Renderer ABC
-    r = render_mod.Renderer(l.projector["PROJECTOR_WIDTH"], l.projector["PROJECTOR_HEIGHT"])
-    r.setup()
+    # Headless runs open no windows and poll no keys, for servers and CI
+    headless = l.projector.get("HEADLESS", False)
+    debug_preview = open_preview(l)
+    source = open_source(l)
+    r = open_renderer(l)
+
+    # Optional caps, mostly for headless throughput tests
+    max_frames = l.projector.get("MAX_FRAMES", 0)
+    max_seconds = l.projector.get("MAX_SECONDS", 0)
+    frames = 0
+    started = time.monotonic()
+
+    recorder = None
+    if l.projector.get("RECORD_SNAPSHOTS"):
+        recorder = recording.SnapshotRecorder(l.projector["RECORD_SNAPSHOTS"])
+
+    # Optionally filter markers across frames, and extrapolate them to when
+    # the frame will be on the table
+    positions = l.projector.get("MARKER_POSITIONS", "raw")
+    if positions not in ("raw", "smoothed", "predicted"):
+        raise ValueError("MARKER_POSITIONS must be raw, smoothed or predicted, not %r" % positions)
+    tracker:Optional[tracking.MarkerTracker] = None
+    if positions != "raw":
+        tracker = tracking.MarkerTracker(
+            process_noise=l.projector.get("MOTION_PROCESS_NOISE", 2e4),
+            measurement_noise=l.projector.get("MOTION_MEASUREMENT_NOISE", 2.0),
+            reset_distance=l.projector.get("MOTION_RESET_DISTANCE", 100.0),
+            hold=l.projector.get("MOTION_HOLD", 0.0),
+        )
+    # Projector lag on top of the measured render time
+    display_latency = l.projector.get("DISPLAY_LATENCY", 0.0)
+    render_time = 0.0
+
+    retained = l.projector.get("RETAINED_RENDERING", False)
+    # Draw over the camera image warped into projector space, or on black
+    draw_on_camera = l.projector.get("DRAW_ON_CAMERA", True)
+    ctx = context.DrawingContext(l.projector["PROJECTOR_WIDTH"], l.projector["PROJECTOR_HEIGHT"])
 
     # App loop
-    while True:
-
-        handle_keyevents(l, r)
-        snap, image, frame = l.get_snapshot()
-
-        if image is not None:
-            SRC_CORNERS:Corners = np.array(l.projector["SRC_CORNERS"])
-            debug:Image = np.copy(frame)
-            items = snap.markers.items()
-            if items:
-                markers = [m for i in items for m in i[1]]
-                ids:npt.NDArray[int] = np.array([m.id for m in markers])
-                corners = [m.raw_corners for m in markers]
-                cv2.aruco.drawDetectedMarkers(debug, corners, ids)
-            debug = cv2.polylines(debug, pts=[SRC_CORNERS.astype(int)], isClosed=True, color=(255,255,255))
-
-            cv2.imshow("Tinycam", debug)
-
-        if l.projector.get("CALIBRATE"):
-            r.show_calibration_markers()
-        else:
-            ctx = context.DrawingContext(l.projector["PROJECTOR_WIDTH"], l.projector["PROJECTOR_HEIGHT"])
-
-            # Run the user defined app
-            if render_direct is not None:
-                image = render_direct(snap, image)
-
-            render_ctx(snap, ctx)
-            r.render(ctx, image)
+    timer = timing.FrameTimer(enabled=l.projector.get("PROFILE", False), log_path=l.projector.get("PROFILE_LOG"))
+    timing.install(timer)
+    overlay = l.projector.get("PROFILE_OVERLAY", True)
+
+    # With RENDER_FPS set, detection runs on its own thread and the app and
+    # renderer tick at that rate with the newest Snapshot
+    render_fps = l.projector.get("RENDER_FPS", 0)
+    detection:Optional[scheduler.DetectionLoop] = None
+    if render_fps:
+        detection = scheduler.DetectionLoop(source, profile=timer.enabled)
+        detection.start()
+    last_seq = -1
+    last_tick:Optional[float] = None
+    next_tick = time.monotonic()
+    try:
+        while True:
+            timer.begin_frame()
+
+            if not headless:
+                with timer.span("keys"):
+                    handle_keyevents(l, r)
+            if detection is not None:
+                snap, seq = detection.latest()
+                fresh = seq != last_seq
+                last_seq = seq
+            elif source is l:
+                snap = l.get_snapshot()
+                fresh = True
+            else:
+                with timer.span("source"):
+                    snap = source.get_snapshot()
+                fresh = True
+            # Detect up front so detection is timed in its own span, rather
+            # than inside whichever stage reads the markers first
+            snap.detect()
+            if recorder is not None and fresh:
+                recorder.write(snap)
+
+            if debug_preview is not None:
+                with timer.span("debug"):
+                    if snap.frame is not None and fresh and debug_preview.due():
+                        lines = []
+                        if overlay:
+                            lines = timer.overlay_lines()
+                            if detection is not None:
+                                lines += detection.timer.overlay_lines("detection")
+                        frame, markers, src_corners = l.preview_inputs(snap)
+                        debug_preview.submit(frame, markers, src_corners, lines)
+                    debug_preview.show()
+
+            if l.projector.get("CALIBRATE"):
+                r.show_calibration_markers()
+                last_tick = None
+            else:
+                if retained:
+                    # Reuse the context so the renderer only redraws what changed
+                    ctx.clear()
+                else:
+                    ctx = context.DrawingContext(l.projector["PROJECTOR_WIDTH"], l.projector["PROJECTOR_HEIGHT"])
+
+                now = time.monotonic()
+                ctx.dt = 0.0 if last_tick is None else now - last_tick
+                ctx.snapshot_age = now - snap.timestamp
+                last_tick = now
+
+                if tracker is not None:
+                    with timer.span("tracking"):
+                        if fresh:
+                            tracker.update(snap.raw_markers, snap.timestamp)
+                            snap.smoothed_markers = tracker.smoothed()
+                        snap.predicted_markers = tracker.predicted(now + render_time + display_latency)
+                        snap.markers = snap.predicted_markers if positions == "predicted" else snap.smoothed_markers
+
+                # Warp before the app, so the warp is timed in its own span
+                # rather than inside the app's. Markers were already detected,
+                # as they may be found in this image and the app draws on it.
+                image = None
+                if render_direct is not None or (draw_on_camera and not retained):
+                    # Only now is the frame warped into projector space
+                    image = snap.projector_image
+                    if detection is not None:
+                        with timer.span("warp"):
+                            # The app and renderer draw on it, and it's reused next tick
+                            image = np.copy(image)
+
+                # Run the user defined app
+                with timer.span("app"):
+                    if render_direct is not None:
+                        image = render_direct(snap, image)
+
+                    render_ctx(snap, ctx)
+                with timer.span("render"):
+                    render_started = time.monotonic()
+                    r.render(ctx, image)
+                    render_time += 0.1 * (time.monotonic() - render_started - render_time)
+
+            if detection is not None:
+                with timer.span("idle"):
+                    next_tick += 1.0 / render_fps
+                    delay = next_tick - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    else:
+                        # Running behind, so don't try to catch up
+                        next_tick = time.monotonic()
+            timer.end_frame()
+
+            frames += 1
+            if max_frames and frames >= max_frames:
+                break
+            if max_seconds and time.monotonic() - started >= max_seconds:
+                break
+    finally:
+        elapsed = time.monotonic() - started
+        print("Ran %s frames in %.1fs (%.1f FPS)" % (frames, elapsed, frames / elapsed if elapsed else 0))
+        timer.close()
+        if debug_preview is not None:
+            debug_preview.close()
+        if detection is not None:
+            detection.stop()
+        if recorder is not None:
+            recorder.close()
+        if isinstance(source, pipeline.Pipeline):
+            source.close()
+        l.close()
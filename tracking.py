@@ -0,0 +1,172 @@
+import numpy as np
+import numpy.typing as npt
+
+import snapshot
+
+
+def _keys(markers:snapshot.MarkerSet) -> npt.NDArray[np.int64]:
+    """Key for each marker: its id, and its rank by x among markers with that id.
+
+    Repeated ids are told apart by their left to right order, which holds as
+    long as two markers with the same id don't cross.
+    """
+    ids = markers.ids.astype(np.int64)
+    if not len(ids):
+        return ids
+    order = np.lexsort((markers.centers[:, 0], ids))
+    sorted_ids = ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    group_start = starts[np.cumsum(np.r_[False, sorted_ids[1:] != sorted_ids[:-1]])]
+    ranks = np.empty(len(ids), np.int64)
+    ranks[order] = np.arange(len(ids)) - group_start
+    return (ids << 16) | ranks
+
+
+class MarkerTracker:
+    """Constant-velocity Kalman filters for every marker seen, across Snapshots.
+
+    Each of a marker's 8 corner coordinates has a position and velocity
+    state. They share a noise model, so one 2 x 2 covariance per marker
+    serves all 8, and every step is done with array operations over all
+    tracked markers at once. Centers and rotations are computed from the
+    filtered corners, so they are smoothed and predicted too.
+
+    A marker that jumps further than reset_distance from where it was
+    expected, e.g. because it was picked up and put down elsewhere, starts
+    again from its new position instead of gliding there.
+
+    Args:
+        process_noise (float): how freely markers accelerate, in px^2 / s^3
+        measurement_noise (float): variance of detected corners, in px^2
+        reset_distance (float): jump in px after which a track starts again
+        hold (float): seconds to keep reporting a marker after it was last
+          detected, to bridge missed detections
+        timeout (float): seconds after which an unseen marker is forgotten
+        max_lead (float): furthest ahead in seconds to extrapolate
+    """
+
+    def __init__(
+        self,
+        process_noise:float=2e4,
+        measurement_noise:float=2.0,
+        reset_distance:float=100.0,
+        hold:float=0.0,
+        timeout:float=1.0,
+        max_lead:float=0.25,
+    ):
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.reset_distance = reset_distance
+        self.hold = hold
+        self.timeout = timeout
+        self.max_lead = max_lead
+        self.time = 0.0
+
+        # Tracks sorted by key
+        self.keys = np.zeros(0, np.int64)
+        self.position = np.zeros((0, 8))
+        self.velocity = np.zeros((0, 8))
+        self.covariance = np.zeros((0, 2, 2))
+        self.raw_corners = np.zeros((0, 4, 2), np.float32)
+        self.last_seen = np.zeros(0)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _predict(self, dt):
+        """Advance every track by dt seconds (one per track)."""
+        self.position += self.velocity * dt[:, None]
+        P = self.covariance
+        q = self.process_noise
+        p00, p01, p10, p11 = P[:, 0, 0], P[:, 0, 1], P[:, 1, 0], P[:, 1, 1]
+        # P = F P F^T + Q for F = [[1, dt], [0, 1]] and white noise acceleration
+        self.covariance = np.stack([
+            np.stack([p00 + dt * (p01 + p10) + dt * dt * p11 + q * dt ** 3 / 3, p01 + dt * p11 + q * dt ** 2 / 2], axis=1),
+            np.stack([p10 + dt * p11 + q * dt ** 2 / 2, p11 + q * dt], axis=1),
+        ], axis=1)
+
+    def update(self, markers:snapshot.MarkerSet, timestamp:float) -> None:
+        """Fold in the markers detected in a frame captured at timestamp."""
+        if len(self.keys):
+            self._predict(np.full(len(self.keys), max(timestamp - self.time, 0.0)))
+        self.time = timestamp
+
+        keys = _keys(markers)
+        measured = markers.corners.reshape(-1, 8).astype(np.float64)
+        slots = np.searchsorted(self.keys, keys)
+        known = slots < len(self.keys)
+        known[known] = self.keys[slots[known]] == keys[known]
+
+        if known.any():
+            i, z = slots[known], measured[known]
+            # Start again from markers that moved too far to follow
+            jump = np.abs(z - self.position[i]).max(axis=1) > self.reset_distance
+            self._reset(i[jump], z[jump])
+            i, z = i[~jump], z[~jump]
+
+            P = self.covariance[i]
+            S = P[:, 0, 0] + self.measurement_noise
+            k0, k1 = P[:, 0, 0] / S, P[:, 1, 0] / S
+            residual = z - self.position[i]
+            self.position[i] += k0[:, None] * residual
+            self.velocity[i] += k1[:, None] * residual
+            self.covariance[i] = np.stack([
+                np.stack([(1 - k0) * P[:, 0, 0], (1 - k0) * P[:, 0, 1]], axis=1),
+                np.stack([P[:, 1, 0] - k1 * P[:, 0, 0], P[:, 1, 1] - k1 * P[:, 0, 1]], axis=1),
+            ], axis=1)
+            self.raw_corners[slots[known]] = markers.raw_corners[known]
+            self.last_seen[slots[known]] = timestamp
+
+        if not known.all():
+            self._add(keys[~known], measured[~known], markers.raw_corners[~known], timestamp)
+
+        alive = timestamp - self.last_seen <= self.timeout
+        if not alive.all():
+            self._select(alive)
+
+    def _reset(self, slots, measured):
+        self.position[slots] = measured
+        self.velocity[slots] = 0
+        self.covariance[slots] = self._initial_covariance(len(slots))
+
+    def _initial_covariance(self, n):
+        # Position as good as one measurement; velocity of up to a few
+        # thousand px / s is plausible
+        covariance = np.zeros((n, 2, 2))
+        covariance[:, 0, 0] = self.measurement_noise
+        covariance[:, 1, 1] = 1000.0 ** 2
+        return covariance
+
+    def _add(self, keys, measured, raw_corners, timestamp):
+        self.keys = np.append(self.keys, keys)
+        self.position = np.vstack([self.position, measured])
+        self.velocity = np.vstack([self.velocity, np.zeros_like(measured)])
+        self.covariance = np.concatenate([self.covariance, self._initial_covariance(len(keys))])
+        self.raw_corners = np.concatenate([self.raw_corners, raw_corners.astype(np.float32)])
+        self.last_seen = np.append(self.last_seen, np.full(len(keys), timestamp))
+        self._select(np.argsort(self.keys, kind="stable"))
+
+    def _select(self, index):
+        self.keys = self.keys[index]
+        self.position = self.position[index]
+        self.velocity = self.velocity[index]
+        self.covariance = self.covariance[index]
+        self.raw_corners = self.raw_corners[index]
+        self.last_seen = self.last_seen[index]
+
+    def _marker_set(self, corners:npt.NDArray[np.float64]) -> snapshot.MarkerSet:
+        shown = self.time - self.last_seen <= self.hold
+        return snapshot.MarkerSet(
+            (self.keys[shown] >> 16).astype(np.int32),
+            corners[shown].reshape(-1, 4, 2).astype(np.float32),
+            self.raw_corners[shown],
+        )
+
+    def smoothed(self) -> snapshot.MarkerSet:
+        """Filtered markers at the time of the last update."""
+        return self._marker_set(self.position)
+
+    def predicted(self, at_time:float) -> snapshot.MarkerSet:
+        """Markers extrapolated to at_time, e.g. when the frame will be shown."""
+        lead = min(max(at_time - self.time, 0.0), self.max_lead)
+        return self._marker_set(self.position + self.velocity * lead)